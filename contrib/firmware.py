@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""Resolve and download OpenWrt firmware images through a local cache
+
+A device is described by the base URL of a release (or the snapshots), its
+target (x86-64, ath79-generic, ...), its profile and the suffix of the image
+name from labnet.yaml (initramfs-kernel.bin, ...). The image name is looked
+up in profiles.json of the target, falling back to sha256sums, which also
+provides the checksum. The firmware version is read from version.buildinfo,
+or the version_code in profiles.json.
+
+Images are stored in a content-addressed cache, named by their SHA256. If
+the checksum of an image is already in the cache it is not downloaded again,
+otherwise the download is conditional on the ETag or Last-Modified of the
+previous download of the same URL. The least recently used images are
+evicted once the cache exceeds --cache-size. Downloads run in parallel and
+their checksum is verified before they enter the cache.
+
+    firmware.py --url URL --target x86-64 --profile generic \\
+        --output DIR generic-squashfs-combined.img.gz
+
+The variables FIRMWARE_VERSION and FIRMWARE_FILE (or --variable) are
+printed for $GITHUB_ENV. Any HTTP server serving a copy of the download
+tree works as --url, e.g. python3 -m http.server for offline tests.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import urllib.error
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_CACHE = Path(
+    os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"),
+    "openwrt-tests",
+    "firmware",
+)
+
+
+class FirmwareError(Exception):
+    pass
+
+
+def fetch_text(url, timeout=30):
+    """Return the content of url, None if it does not exist"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read().decode()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise FirmwareError(f"{url}: {e}") from e
+    except urllib.error.URLError as e:
+        raise FirmwareError(f"{url}: {e.reason}") from e
+
+
+def parse_sha256sums(text):
+    """Map the file names in a sha256sums file to their checksum"""
+    checksums = {}
+    for line in (text or "").splitlines():
+        checksum, _, name = line.partition(" ")
+        name = name.strip().lstrip("*")
+        if name:
+            checksums[name] = checksum
+    return checksums
+
+
+def find_image(profiles, checksums, target, profile, firmware):
+    """Return name and checksum of the image of profile ending with firmware"""
+    images = (profiles or {}).get("profiles", {}).get(profile, {}).get("images", [])
+    for image in images:
+        if image["name"].endswith(f"-{firmware}"):
+            return image["name"], image.get("sha256") or checksums.get(image["name"])
+
+    # kernels like vmlinux-initramfs.elf are not listed as images of a
+    # profile, and snapshots of old releases come without profiles.json
+    suffixes = [f"-{target}-{profile}-{firmware}"] if profile else []
+    suffixes.append(f"-{target}-{firmware}")
+    for suffix in suffixes:
+        for name, checksum in sorted(checksums.items()):
+            if name.endswith(suffix):
+                return name, checksum
+
+    raise FirmwareError(f"No image {firmware} for {target}/{profile or '-'}")
+
+
+def resolve(url, target, profile, firmwares):
+    """Return the version and the (url, name, checksum) of every firmware"""
+    target_url = f"{url.rstrip('/')}/{target.replace('-', '/', 1)}"
+    with ThreadPoolExecutor() as pool:
+        profiles, sha256sums, buildinfo = pool.map(
+            fetch_text,
+            [
+                f"{target_url}/profiles.json",
+                f"{target_url}/sha256sums",
+                f"{target_url}/version.buildinfo",
+            ],
+        )
+
+    if profiles is not None:
+        try:
+            profiles = json.loads(profiles)
+        except json.JSONDecodeError as e:
+            raise FirmwareError(f"{target_url}/profiles.json: {e}") from e
+    if profiles is None and sha256sums is None:
+        raise FirmwareError(f"Neither profiles.json nor sha256sums in {target_url}")
+
+    checksums = parse_sha256sums(sha256sums)
+    version = (buildinfo or "").strip() or (profiles or {}).get("version_code")
+
+    images = []
+    for firmware in firmwares:
+        name, checksum = find_image(profiles, checksums, target, profile, firmware)
+        images.append((f"{target_url}/{name}", name, checksum))
+    return version, images
+
+
+class FirmwareCache:
+    """Content-addressed store of firmware images
+
+    Images are stored as objects/<sha256>. urls.json remembers the checksum,
+    ETag and Last-Modified of every downloaded URL for conditional requests.
+    """
+
+    def __init__(self, path, max_size=4 * 1024**3):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.objects = self.path / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.urls_file = self.path / "urls.json"
+        try:
+            self.urls = json.loads(self.urls_file.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.urls = {}
+
+    def object(self, checksum):
+        return self.objects / checksum
+
+    def lookup(self, checksum):
+        """Return the cached object of checksum, marked as recently used"""
+        path = self.object(checksum)
+        if not path.exists():
+            return None
+        os.utime(path)
+        return path
+
+    def fetch(self, url, checksum=None, timeout=60):
+        """Return the cached object of url, downloading it if required"""
+        if checksum and (path := self.lookup(checksum)):
+            return path
+
+        request = urllib.request.Request(url)
+        known = self.urls.get(url, {})
+        if known.get("sha256") and self.object(known["sha256"]).exists():
+            if known.get("etag"):
+                request.add_header("If-None-Match", known["etag"])
+            if known.get("last_modified"):
+                request.add_header("If-Modified-Since", known["last_modified"])
+
+        try:
+            response = urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise FirmwareError(f"{url}: {e}") from e
+            response = None
+        except urllib.error.URLError as e:
+            raise FirmwareError(f"{url}: {e.reason}") from e
+
+        if response is None:
+            digest = known["sha256"]
+            if checksum and digest != checksum:
+                raise FirmwareError(f"{url}: not modified, but checksum differs")
+        else:
+            with response:
+                digest = self.store(url, response, checksum)
+            self.urls[url] = {
+                "sha256": digest,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+
+        return self.lookup(digest)
+
+    def store(self, url, response, checksum=None):
+        """Write response into the cache if it matches checksum, return its checksum"""
+        sha256 = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as f:
+            try:
+                while chunk := response.read(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+        digest = sha256.hexdigest()
+        if checksum and digest != checksum:
+            os.unlink(f.name)
+            raise FirmwareError(f"{url}: checksum {digest}, expected {checksum}")
+
+        os.replace(f.name, self.object(digest))
+        return digest
+
+    def save(self):
+        objects = {path.name for path in self.objects.iterdir()}
+        self.urls = {
+            url: known for url, known in self.urls.items() if known["sha256"] in objects
+        }
+        self.urls_file.write_text(json.dumps(self.urls, indent=2))
+
+    def evict(self, keep=()):
+        """Remove the least recently used objects until the cache fits max_size"""
+        objects = sorted(
+            (path.stat().st_mtime, path.stat().st_size, path)
+            for path in self.objects.iterdir()
+        )
+        size = sum(size for _, size, _ in objects)
+        for _, object_size, path in objects:
+            if size <= self.max_size:
+                break
+            if path.name in keep:
+                continue
+            path.unlink()
+            size -= object_size
+        self.save()
+
+
+def gunzip(source, destination):
+    """Decompress source, ignoring data after the end of the gzip stream
+
+    OpenWrt appends metadata to many gzip compressed images, which the
+    gzip module would reject.
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        while not decompressor.eof and (chunk := src.read(CHUNK_SIZE)):
+            dst.write(decompressor.decompress(chunk))
+        dst.write(decompressor.flush())
+
+
+def install(path, destination, decompress=False):
+    """Put a cached object at destination, return the path of the image"""
+    destination = Path(destination)
+    if decompress and destination.suffix == ".gz":
+        destination = destination.with_suffix("")
+        gunzip(path, destination)
+    else:
+        # a copy, QEMU may write to disk images
+        shutil.copyfile(path, destination)
+    return destination
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", required=True, help="base URL of the targets")
+    parser.add_argument("--target", required=True, help="target, e.g. x86-64")
+    parser.add_argument("--profile", default="", help="profile, e.g. generic")
+    parser.add_argument("--output", default=".", help="directory for the images")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="cache directory")
+    parser.add_argument(
+        "--cache-size", type=int, default=4 * 1024**3, help="cache size in bytes"
+    )
+    parser.add_argument(
+        "--decompress", action="store_true", help="decompress .gz images"
+    )
+    parser.add_argument(
+        "--variable", default="FIRMWARE_FILE", help="variable for the image path"
+    )
+    parser.add_argument("firmware", nargs="+", help="image name suffix")
+    args = parser.parse_args()
+
+    cache = FirmwareCache(args.cache, args.cache_size)
+    try:
+        version, images = resolve(args.url, args.target, args.profile, args.firmware)
+        with ThreadPoolExecutor() as pool:
+            paths = list(
+                pool.map(lambda image: cache.fetch(image[0], image[2]), images)
+            )
+    except FirmwareError as e:
+        cache.save()
+        print(e, file=sys.stderr)
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+    outputs = []
+    for (url, name, _), path in zip(images, paths):
+        output = install(path, Path(args.output, name), args.decompress)
+        outputs.append(str(output.resolve()))
+        print(f"{url} -> {output}", file=sys.stderr)
+
+    cache.evict(keep={path.name for path in paths})
+
+    print(f"FIRMWARE_VERSION={version or ''}")
+    print(f"{args.variable}={' '.join(outputs)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Store test metrics of many runs and detect performance regressions
+
+Metrics are read from junit reports written by pytest --junitxml: the
+results_bag of every test and the properties of the session (boot timings,
+SSH and flash statistics, ...). Every run is keyed by device, version name
+and the BUILD_ID of the firmware.
+
+    history.py ingest report.xml [--device ...] [--version-name ...]
+    history.py compare report.xml [--window 10] [--threshold 3.5]
+"""
+
+import argparse
+import json
+import sqlite3
+import statistics
+import sys
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    version_name TEXT NOT NULL,
+    build_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    UNIQUE (device, version_name, build_id, timestamp)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (run_id, name)
+);
+"""
+
+# Metrics with one of these words in their name are better when higher, all
+# others (times, memory used, load, ...) are better when lower
+HIGHER_IS_BETTER = (
+    "available",
+    "entropy",
+    "free",
+    "mbps",
+    "saved",
+    "skipped",
+    "throughput",
+)
+
+# Keys of distributions like {"min": ..., "median": ..., "stdev": ...}. The
+# location keys take the direction of their metric, a smaller spread is
+# always better.
+LOCATION_KEYS = ("min", "max", "mean", "median")
+SPREAD_KEYS = ("stdev", "mad")
+
+
+def higher_is_better(name):
+    """Whether a higher value of the metric name is an improvement"""
+    # test names like test_free_memory say nothing about the direction
+    keys = (name.partition(".")[2] or name).split(".")
+    if keys[-1] in SPREAD_KEYS:
+        return False
+    while len(keys) > 1 and keys[-1] in LOCATION_KEYS:
+        keys.pop()
+    return any(word in HIGHER_IS_BETTER for word in keys[-1].split("_"))
+
+
+# Properties of the session which are metrics of the DUT. The others, like
+# the number of SSH commands or the timeouts learned from the history, only
+# describe the test run.
+SESSION_METRICS = ("boot_", "flash_", "facts_delta_", "ssh_handshake_time")
+# results_bag entries describing the test setup instead of the DUT
+TEST_BOOKKEEPING = ("streams", "feed_cache_hits", "feed_cache_misses")
+
+
+def flatten(name, value):
+    """Yield (name, number) for all numbers in a nested JSON value"""
+    if isinstance(value, bool):
+        return
+    if isinstance(value, int | float):
+        yield name, float(value)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(f"{name}.{key}", item)
+
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except (TypeError, json.JSONDecodeError):
+        return text
+
+
+def read_report(path):
+    """Return the run properties and the metrics of a junit report"""
+    root = ET.parse(path).getroot()
+    suite = root if root.tag == "testsuite" else root.find("testsuite")
+
+    properties = {
+        prop.get("name"): prop.get("value")
+        for prop in suite.findall("./properties/property")
+    }
+    # conftest.py adds the properties of the session to the test reports
+    for prop in suite.findall("./testcase/properties/property"):
+        name = prop.get("name")
+        if name.startswith("session."):
+            properties[name.removeprefix("session.")] = prop.get("value")
+
+    run = {
+        "device": properties.get("device"),
+        "version_name": properties.get("version_name"),
+        "build_id": None,
+        "timestamp": suite.get("timestamp") or datetime.now().isoformat(),
+    }
+
+    metrics = {}
+    # used by contrib/matrix.py to order the jobs
+    if suite.get("time"):
+        metrics["session_duration"] = float(suite.get("time"))
+    for name, value in properties.items():
+        if name.startswith(SESSION_METRICS):
+            metrics.update(flatten(name, parse_value(value)))
+
+    for case in suite.iter("testcase"):
+        test = case.get("name")
+        for prop in case.findall("./properties/property"):
+            name, value = prop.get("name"), prop.get("value")
+            if name.startswith("session."):
+                continue
+            if name == "firmware_version":
+                run["build_id"] = value
+            if name in TEST_BOOKKEEPING:
+                continue
+            metrics.update(flatten(f"{test}.{name}", parse_value(value)))
+
+    return run, metrics
+
+
+def open_db(path):
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def ingest(db, run, metrics):
+    """Store a run, return its id. Ingesting a run twice is a no-op."""
+    cursor = db.execute(
+        "INSERT OR IGNORE INTO runs (device, version_name, build_id, timestamp) "
+        "VALUES (:device, :version_name, :build_id, :timestamp)",
+        run,
+    )
+    if cursor.rowcount == 0:
+        return db.execute(
+            "SELECT id FROM runs WHERE device = :device AND "
+            "version_name = :version_name AND build_id = :build_id AND "
+            "timestamp = :timestamp",
+            run,
+        ).fetchone()[0]
+
+    run_id = cursor.lastrowid
+    db.executemany(
+        "INSERT INTO metrics (run_id, name, value) VALUES (?, ?, ?)",
+        [(run_id, name, value) for name, value in metrics.items()],
+    )
+    db.commit()
+    return run_id
+
+
+def baseline(db, run, name, window):
+    """Values of a metric in the last window runs before run, oldest first"""
+    rows = db.execute(
+        "SELECT value FROM metrics JOIN runs ON runs.id = metrics.run_id "
+        "WHERE device = ? AND version_name = ? AND name = ? AND timestamp < ? "
+        "ORDER BY timestamp DESC LIMIT ?",
+        (run["device"], run["version_name"], name, run["timestamp"], window),
+    ).fetchall()
+    return [value for (value,) in reversed(rows)]
+
+
+def compare(db, run, metrics, window=10, threshold=3.5, min_runs=3):
+    """Return the metrics of run which regressed against the rolling baseline
+
+    A metric regressed if its robust z-score (based on median and median
+    absolute deviation) exceeds threshold in the bad direction. If all
+    baseline values are equal, a change of more than 10% counts.
+    """
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        values = baseline(db, run, name, window)
+        if len(values) < min_runs:
+            continue
+
+        median = statistics.median(values)
+        mad = statistics.median(abs(v - median) for v in values)
+        if mad:
+            score = 0.6745 * (value - median) / mad
+        elif median:
+            score = threshold * (value - median) / (0.1 * abs(median))
+        else:
+            score = threshold * 2 if value else 0.0
+
+        if higher_is_better(name):
+            score = -score
+
+        if score > threshold:
+            regressions.append((name, value, median, round(score, 2)))
+
+    return regressions
+
+
+def load(args, path):
+    """Return the run and metrics of a report, None if the run is incomplete
+
+    The build_id is missing if test_firmware_version failed or was skipped,
+    which must not stop the other reports of a batch from being processed.
+    """
+    run, metrics = read_report(path)
+    for key in ("device", "version_name", "build_id"):
+        if getattr(args, key):
+            run[key] = getattr(args, key)
+        if not run[key]:
+            print(
+                f"{path}: {key} not found in the report, skipping it "
+                f"(pass --{key.replace('_', '-')})",
+                file=sys.stderr,
+            )
+            return None
+    return run, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="history.sqlite", help="SQLite database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command in ("ingest", "compare"):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument("reports", nargs="+", help="junit report files")
+        subparser.add_argument("--device", dest="device")
+        subparser.add_argument("--version-name", dest="version_name")
+        subparser.add_argument("--build-id", dest="build_id")
+
+    compare_parser = subparsers.choices["compare"]
+    compare_parser.add_argument("--window", type=int, default=10)
+    compare_parser.add_argument("--threshold", type=float, default=3.5)
+    compare_parser.add_argument("--min-runs", type=int, default=3)
+
+    args = parser.parse_args()
+    db = open_db(args.db)
+
+    regressed = False
+    for path in args.reports:
+        loaded = load(args, path)
+        if loaded is None:
+            continue
+        run, metrics = loaded
+        if args.command == "ingest":
+            ingest(db, run, metrics)
+            print(f"{path}: {len(metrics)} metrics of {run['device']}")
+            continue
+
+        regressions = compare(
+            db, run, metrics, args.window, args.threshold, args.min_runs
+        )
+        for name, value, median, score in regressions:
+            print(
+                f"{run['device']} ({run['version_name']}): {name} is {value:g}, "
+                f"baseline {median:g} (score {score})"
+            )
+        regressed |= bool(regressions)
+
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Generate the job matrices of the workflows from labnet.yaml
+
+Every device of labnet.yaml is tested once per version (snapshot, stable and
+oldstable). All versions of a device run in a single job, so the device is
+reserved, locked and powered off only once. Jobs are ordered longest first,
+using the duration of the previous sessions of every device and version from
+the history database of contrib/history.py. The runtime of the whole matrix
+is estimated by scheduling the jobs on a fake coordinator, which hands out
+places like labgrid-client reserve --wait.
+
+    matrix.py [--versions URL] [--issues FILE] [--history DB]
+
+The matrices are printed as name=value lines for $GITHUB_OUTPUT.
+"""
+
+import argparse
+import heapq
+import json
+import sqlite3
+import statistics
+import sys
+import urllib.request
+
+import yaml
+
+VERSIONS_URL = "https://downloads.openwrt.org/.versions.json"
+MIRROR_URL = "https://mirror-03.infra.openwrt.org"
+
+# Seconds a test session takes on a device without history
+DEFAULT_DURATION = 900
+
+# Seconds every job spends on setup, reserving, locking and powering off
+JOB_OVERHEAD = 120
+
+QEMU_TARGETS = [
+    {
+        "target": "malta-be",
+        "firmware": "vmlinux-initramfs.elf",
+        "dependency": "qemu-system-mips",
+    },
+    {
+        "target": "x86-64",
+        "firmware": "generic-squashfs-combined.img.gz",
+        "dependency": "qemu-system-x86",
+    },
+    {
+        "target": "armsr-armv8",
+        "firmware": "generic-initramfs-kernel.bin",
+        "dependency": "qemu-system-aarch64",
+    },
+]
+
+
+def load_versions(url):
+    """Return the snapshot, stable and oldstable versions with their URLs"""
+    with urllib.request.urlopen(url, timeout=30) as response:
+        versions = json.load(response)
+
+    result = [
+        {
+            "version_name": "snapshot",
+            "version_url": f"{MIRROR_URL}/snapshots/targets",
+        }
+    ]
+    for key in ("stable_version", "oldstable_version"):
+        branch = ".".join(versions[key].split(".")[:2])
+        result.append(
+            {
+                "version_name": branch,
+                "version_url": f"{MIRROR_URL}/releases/{branch}-SNAPSHOT/targets",
+            }
+        )
+    return result
+
+
+def load_devices(labnet, issues=()):
+    """Return an entry for every device of every lab, each device only once
+
+    Devices with an open healthcheck issue in a lab are left out of it, unless
+    they are tested on snapshots only.
+    """
+    devices = labnet["devices"]
+    entries = {}
+    for lab in labnet["labs"].values():
+        for device in lab["devices"]:
+            if device not in devices or device in entries:
+                continue
+
+            snapshots_only = devices[device].get("snapshots_only", False)
+            if not snapshots_only and any(
+                f"{lab['proxy']}/{device}" in issue for issue in issues
+            ):
+                continue
+
+            entries[device] = {
+                "device": device,
+                "name": devices[device]["name"],
+                "proxy": lab["proxy"],
+                "target": devices[device]["target"],
+                "firmware": devices[device]["firmware"],
+                "maintainers": lab["maintainers"],
+                "snapshots_only": snapshots_only,
+            }
+    return list(entries.values())
+
+
+def load_durations(path, window=10):
+    """Median session duration of the last window runs per (device, version)"""
+    if not path:
+        return {}
+    try:
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        rows = db.execute(
+            "SELECT device, version_name, value FROM metrics "
+            "JOIN runs ON runs.id = metrics.run_id "
+            "WHERE name = 'session_duration' ORDER BY timestamp DESC"
+        ).fetchall()
+    except sqlite3.Error:
+        return {}
+
+    samples = {}
+    for device, version_name, value in rows:
+        values = samples.setdefault((device, version_name), [])
+        if len(values) < window:
+            values.append(value)
+    return {key: statistics.median(values) for key, values in samples.items()}
+
+
+def estimate(durations, device, version_name):
+    """Expected session duration, falling back to other versions of the device"""
+    if (device, version_name) in durations:
+        return durations[(device, version_name)]
+    same_device = [value for (d, _), value in durations.items() if d == device]
+    if same_device:
+        return statistics.median(same_device)
+    if durations:
+        return statistics.median(durations.values())
+    return DEFAULT_DURATION
+
+
+def batch_jobs(devices, versions, durations):
+    """One job per device running all versions, longest first"""
+    jobs = []
+    for device in devices:
+        job = dict(device, versions=versions)
+        job["duration"] = round(
+            JOB_OVERHEAD
+            + sum(
+                estimate(durations, device["device"], version["version_name"])
+                for version in versions
+            )
+        )
+        jobs.append(job)
+    return sorted(jobs, key=lambda job: (-job["duration"], job["device"]))
+
+
+class FakeCoordinator:
+    """Hands out places in the order they were reserved, like labgrid does"""
+
+    def __init__(self):
+        self.free_at = {}
+
+    def reserve(self, place, now, duration):
+        """Return when a reservation of place made at now is acquired"""
+        start = max(now, self.free_at.get(place, 0))
+        self.free_at[place] = start + duration
+        return start
+
+
+def simulate(jobs, runners):
+    """Return the seconds until all jobs finished when run in order on runners"""
+    coordinator = FakeCoordinator()
+    free = [0] * runners
+    end = 0
+    for job in jobs:
+        now = heapq.heappop(free)
+        start = coordinator.reserve(job["device"], now, job["duration"])
+        heapq.heappush(free, start + job["duration"])
+        end = max(end, start + job["duration"])
+    return end
+
+
+def output(name, value):
+    print(f"{name}={json.dumps(value, separators=(',', ':'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--labnet", default="labnet.yaml", help="lab description")
+    parser.add_argument("--issues", help="file with open healthcheck issue titles")
+    parser.add_argument("--history", help="history database of contrib/history.py")
+    parser.add_argument(
+        "--runners", type=int, default=8, help="parallel jobs for the estimate"
+    )
+    parser.add_argument("--versions", default=VERSIONS_URL, help=".versions.json")
+    args = parser.parse_args()
+
+    with open(args.labnet) as f:
+        labnet = yaml.safe_load(f)
+
+    issues = []
+    if args.issues:
+        with open(args.issues) as f:
+            issues = [line.strip() for line in f if line.strip()]
+
+    durations = load_durations(args.history)
+
+    versions = load_versions(args.versions)
+    devices = load_devices(labnet, issues)
+    jobs = batch_jobs(devices, versions, durations)
+
+    output("matrix", jobs)
+    output(
+        "devices",
+        [dict(device, **version) for device in devices for version in versions],
+    )
+    output(
+        "qemu-matrix",
+        [dict(qemu, **version) for qemu in QEMU_TARGETS for version in versions],
+    )
+
+    unbatched = [
+        dict(
+            device,
+            duration=JOB_OVERHEAD
+            + estimate(durations, device["device"], v["version_name"]),
+        )
+        for v in versions
+        for device in devices
+    ]
+    print(
+        f"Estimated runtime on {args.runners} runners: "
+        f"{simulate(jobs, args.runners) / 60:.0f} min, "
+        f"{simulate(unbatched, args.runners) / 60:.0f} min unbatched in labnet order",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
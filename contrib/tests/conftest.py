@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the scripts in contrib/ are not a package
+sys.path.insert(0, str(Path(__file__).parent.parent))
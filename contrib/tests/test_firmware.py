@@ -0,0 +1,225 @@
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import firmware
+import pytest
+
+IMAGE = b"\x00openwrt image\x00" * 1000
+KERNEL = b"\x7fELF kernel" * 100
+# OpenWrt appends metadata to gzip compressed images
+TRAILER = b"\x00" * 16 + b'{"metadata_version": "1.1"}'
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        self.server.requests.append(self.path)
+
+
+@pytest.fixture
+def download_server(tmp_path):
+    """Local stand-in for the download server, serving tmp_path/www"""
+    root = tmp_path / "www"
+    root.mkdir()
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        lambda *args: Handler(*args, directory=str(root)),
+    )
+    server.requests = []
+    server.root = root
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def release(download_server):
+    """A target x86-64 with a profiles.json and a malta-be without"""
+    image = gzip.compress(IMAGE) + TRAILER
+    x86 = download_server.root / "x86" / "64"
+    x86.mkdir(parents=True)
+    name = "openwrt-x86-64-generic-squashfs-combined.img.gz"
+    (x86 / name).write_bytes(image)
+    (x86 / "profiles.json").write_text(
+        json.dumps(
+            {
+                "version_code": "r12345-abcdef",
+                "profiles": {
+                    "generic": {"images": [{"name": name, "sha256": sha256(image)}]}
+                },
+            }
+        )
+    )
+
+    malta = download_server.root / "malta" / "be"
+    malta.mkdir(parents=True)
+    kernel = "openwrt-malta-be-vmlinux-initramfs.elf"
+    (malta / kernel).write_bytes(KERNEL)
+    (malta / "sha256sums").write_text(f"{sha256(KERNEL)} *{kernel}\n")
+    (malta / "version.buildinfo").write_text("r23456-fedcba\n")
+
+    return download_server
+
+
+def test_resolve_from_profiles(release):
+    version, images = firmware.resolve(
+        release.url, "x86-64", "generic", ["generic-squashfs-combined.img.gz"]
+    )
+
+    assert version == "r12345-abcdef"
+    [(url, name, checksum)] = images
+    assert name == "openwrt-x86-64-generic-squashfs-combined.img.gz"
+    assert url == f"{release.url}/x86/64/{name}"
+    assert checksum == sha256((release.root / "x86" / "64" / name).read_bytes())
+
+
+def test_resolve_from_sha256sums(release):
+    version, [(_, name, checksum)] = firmware.resolve(
+        release.url, "malta-be", "", ["vmlinux-initramfs.elf"]
+    )
+
+    assert version == "r23456-fedcba"
+    assert name == "openwrt-malta-be-vmlinux-initramfs.elf"
+    assert checksum == sha256(KERNEL)
+
+
+def test_resolve_missing_image(release):
+    with pytest.raises(firmware.FirmwareError, match="No image"):
+        firmware.resolve(release.url, "malta-be", "", ["initramfs-kernel.bin"])
+
+
+def test_resolve_missing_target(release):
+    with pytest.raises(firmware.FirmwareError, match="Neither"):
+        firmware.resolve(release.url, "ath79-generic", "", ["initramfs-kernel.bin"])
+
+
+def test_fetch_uses_cache(release, tmp_path):
+    cache = firmware.FirmwareCache(tmp_path / "cache")
+    url = f"{release.url}/malta/be/openwrt-malta-be-vmlinux-initramfs.elf"
+
+    path = cache.fetch(url, sha256(KERNEL))
+    assert path.name == sha256(KERNEL)
+    assert path.read_bytes() == KERNEL
+
+    requests = len(release.requests)
+    assert cache.fetch(url, sha256(KERNEL)) == path
+    assert len(release.requests) == requests
+
+
+def test_fetch_conditional_request(release, tmp_path):
+    cache = firmware.FirmwareCache(tmp_path / "cache")
+    url = f"{release.url}/malta/be/openwrt-malta-be-vmlinux-initramfs.elf"
+
+    path = cache.fetch(url)
+    cache.save()
+
+    # without a checksum the URL is requested again, but not downloaded
+    cache = firmware.FirmwareCache(tmp_path / "cache")
+    assert cache.fetch(url) == path
+    assert cache.urls[url]["last_modified"]
+
+
+def test_fetch_checksum_mismatch(release, tmp_path):
+    cache = firmware.FirmwareCache(tmp_path / "cache")
+    url = f"{release.url}/malta/be/openwrt-malta-be-vmlinux-initramfs.elf"
+
+    with pytest.raises(firmware.FirmwareError, match="checksum"):
+        cache.fetch(url, "0" * 64)
+
+    assert list(cache.objects.iterdir()) == []
+    assert [path.name for path in cache.path.iterdir()] == ["objects"]
+
+
+def test_fetch_missing(release, tmp_path):
+    cache = firmware.FirmwareCache(tmp_path / "cache")
+
+    with pytest.raises(firmware.FirmwareError, match="404"):
+        cache.fetch(f"{release.url}/malta/be/missing.bin")
+
+
+def test_install_decompresses_with_trailer(release, tmp_path):
+    cache = firmware.FirmwareCache(tmp_path / "cache")
+    name = "openwrt-x86-64-generic-squashfs-combined.img.gz"
+    path = cache.fetch(f"{release.url}/x86/64/{name}")
+
+    output = firmware.install(path, tmp_path / name, decompress=True)
+
+    assert output == tmp_path / name.removesuffix(".gz")
+    assert output.read_bytes() == IMAGE
+    # the cached object stays compressed
+    assert path.read_bytes().startswith(b"\x1f\x8b")
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = firmware.FirmwareCache(tmp_path / "cache", max_size=250)
+    for i, name in enumerate(["old", "newer", "newest"]):
+        path = cache.object(name)
+        path.write_bytes(b"x" * 100)
+        # the mtime marks when an object was used last
+        os.utime(path, (1000 + i, 1000 + i))
+
+    cache.evict(keep={"old"})
+
+    assert sorted(path.name for path in cache.objects.iterdir()) == [
+        "newest",
+        "old",
+    ]
+
+
+def test_main(release, tmp_path, monkeypatch, capsys):
+    output = tmp_path / "images"
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "firmware.py",
+            "--url",
+            release.url,
+            "--target",
+            "x86-64",
+            "--profile",
+            "generic",
+            "--output",
+            str(output),
+            "--cache",
+            str(tmp_path / "cache"),
+            "--decompress",
+            "generic-squashfs-combined.img.gz",
+        ],
+    )
+
+    assert firmware.main() == 0
+
+    image = output / "openwrt-x86-64-generic-squashfs-combined.img"
+    assert capsys.readouterr().out.splitlines() == [
+        "FIRMWARE_VERSION=r12345-abcdef",
+        f"FIRMWARE_FILE={image}",
+    ]
+    assert image.read_bytes() == IMAGE
+
+
+def test_main_fails_on_missing_image(release, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "firmware.py",
+            "--url",
+            release.url,
+            "--target",
+            "malta-be",
+            "--cache",
+            str(tmp_path / "cache"),
+            "initramfs-kernel.bin",
+        ],
+    )
+
+    assert firmware.main() == 1
+    assert "No image initramfs-kernel.bin" in capsys.readouterr().err
@@ -0,0 +1,161 @@
+import history
+import pytest
+
+REPORT = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites>
+  <testsuite name="pytest" time="321.5" timestamp="2026-01-02T03:04:05">
+    <properties>
+      <property name="device" value="openwrt_one" />
+      <property name="version_name" value="snapshot" />
+    </properties>
+    <testcase classname="test_base" name="test_firmware_version">
+      <properties>
+        <property name="firmware_version" value="r12345-abcdef" />
+      </properties>
+    </testcase>
+    <testcase classname="test_base" name="test_memory_usage">
+      <properties>
+        <property name="memory_usage" value="{'used': 1, 'free': 2}" />
+        <property name="used_memory" value="42" />
+        <property name="healthy" value="true" />
+      </properties>
+    </testcase>
+    <testcase classname="test_wifi" name="test_wifi_throughput">
+      <properties>
+        <property name="throughput_mbps" value='{"median": 80.5, "stdev": 2}' />
+        <property name="session.boot_shell" value="12.5" />
+        <property name="session.timeout_shell" value="120" />
+        <property name="session.ssh_commands" value="42" />
+        <property name="streams" value="4" />
+      </properties>
+    </testcase>
+  </testsuite>
+</testsuites>
+"""
+
+
+@pytest.fixture
+def report(tmp_path):
+    path = tmp_path / "report.xml"
+    path.write_text(REPORT)
+    return path
+
+
+def test_flatten():
+    value = {"a": 1, "b": {"c": 2.5, "d": "text", "e": True}, "f": [1, 2]}
+
+    assert dict(history.flatten("x", value)) == {"x.a": 1.0, "x.b.c": 2.5}
+    assert list(history.flatten("x", 3)) == [("x", 3.0)]
+    assert list(history.flatten("x", False)) == []
+
+
+def test_read_report(report):
+    run, metrics = history.read_report(report)
+
+    assert run == {
+        "device": "openwrt_one",
+        "version_name": "snapshot",
+        "build_id": "r12345-abcdef",
+        "timestamp": "2026-01-02T03:04:05",
+    }
+    assert metrics == {
+        "session_duration": 321.5,
+        "boot_shell": 12.5,
+        "test_memory_usage.used_memory": 42.0,
+        "test_wifi_throughput.throughput_mbps.median": 80.5,
+        "test_wifi_throughput.throughput_mbps.stdev": 2.0,
+    }
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("boot_shell", False),
+        ("test_free_memory.used_mb", False),
+        ("test_system_health.memory_usage.available_mb", True),
+        ("test_iperf3.throughput_mbps", True),
+        ("test_wifi.throughput_mbps.median", True),
+        ("test_wifi.throughput_mbps.stdev", False),
+        ("test_wifi.association_time.max", False),
+        ("resource_samples.mem_free_kb.stdev", False),
+        ("flash_saved_seconds", True),
+    ],
+)
+def test_higher_is_better(name, expected):
+    assert history.higher_is_better(name) is expected
+
+
+def ingest_runs(db, name, values):
+    for day, value in enumerate(values, 1):
+        run = {
+            "device": "openwrt_one",
+            "version_name": "snapshot",
+            "build_id": f"r{day}",
+            "timestamp": f"2026-01-{day:02}T00:00:00",
+        }
+        history.ingest(db, run, {name: value})
+    return {**run, "build_id": "new", "timestamp": "2026-02-01T00:00:00"}
+
+
+@pytest.mark.parametrize(
+    "name, value, regressed",
+    [
+        ("boot_shell", 10.1, False),
+        ("boot_shell", 20.0, True),
+        ("boot_shell", 5.0, False),
+        ("test_wifi.throughput_mbps.median", 5.0, True),
+        ("test_wifi.throughput_mbps.median", 20.0, False),
+        ("test_wifi.throughput_mbps.stdev", 20.0, True),
+        ("test_wifi.throughput_mbps.stdev", 5.0, False),
+    ],
+)
+def test_compare(name, value, regressed):
+    db = history.open_db(":memory:")
+    run = ingest_runs(db, name, [10.0, 10.2, 9.8, 10.1, 9.9])
+
+    regressions = history.compare(db, run, {name: value})
+
+    assert bool(regressions) is regressed
+    if regressed:
+        [(metric, new, median, score)] = regressions
+        assert (metric, new, median) == (name, value, 10.0)
+        assert score > 3.5
+
+
+def test_compare_constant_baseline():
+    db = history.open_db(":memory:")
+    run = ingest_runs(db, "boot_shell", [10.0] * 3)
+
+    assert history.compare(db, run, {"boot_shell": 10.5}) == []
+    assert history.compare(db, run, {"boot_shell": 11.5})
+
+
+def test_compare_needs_min_runs():
+    db = history.open_db(":memory:")
+    run = ingest_runs(db, "boot_shell", [10.0, 10.0])
+
+    assert history.compare(db, run, {"boot_shell": 100.0}) == []
+
+
+def test_ingest_twice(report):
+    db = history.open_db(":memory:")
+    run, metrics = history.read_report(report)
+
+    assert history.ingest(db, run, metrics) == history.ingest(db, run, metrics)
+    assert db.execute("SELECT COUNT(*) FROM runs").fetchone() == (1,)
+
+
+def test_main_skips_incomplete_reports(report, tmp_path, monkeypatch, capsys):
+    incomplete = tmp_path / "incomplete.xml"
+    incomplete.write_text(REPORT.replace("firmware_version", "skipped"))
+    db = tmp_path / "history.sqlite"
+    monkeypatch.setattr(
+        "sys.argv",
+        ["history.py", "--db", str(db), "ingest", str(incomplete), str(report)],
+    )
+
+    assert history.main() == 0
+
+    assert "build_id not found" in capsys.readouterr().err
+    runs = history.open_db(db).execute("SELECT build_id FROM runs").fetchall()
+    assert runs == [("r12345-abcdef",)]
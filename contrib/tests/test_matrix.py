@@ -0,0 +1,174 @@
+import history
+import matrix
+
+VERSIONS = [
+    {"version_name": "snapshot", "version_url": "https://example.org/snapshots"},
+    {"version_name": "24.10", "version_url": "https://example.org/24.10"},
+]
+
+LABNET = {
+    "devices": {
+        "device-a": {"name": "A", "target": "ath79-generic", "firmware": "a.bin"},
+        "device-b": {"name": "B", "target": "ramips-mt7621", "firmware": "b.bin"},
+        "device-c": {
+            "name": "C",
+            "target": "mediatek-filogic",
+            "firmware": "c.itb",
+            "snapshots_only": True,
+        },
+    },
+    "labs": {
+        "lab-1": {
+            "proxy": "proxy-1",
+            "maintainers": "@one",
+            "devices": ["device-a", "device-b", "device-unknown"],
+        },
+        "lab-2": {
+            "proxy": "proxy-2",
+            "maintainers": "@two",
+            "devices": ["device-a", "device-c"],
+        },
+    },
+}
+
+
+def write_history(path, durations):
+    db = history.open_db(path)
+    for i, (device, version_name, duration) in enumerate(durations):
+        run = {
+            "device": device,
+            "version_name": version_name,
+            "build_id": f"r{i}",
+            "timestamp": f"2026-01-{i + 1:02d}T00:00:00",
+        }
+        history.ingest(db, run, {"session_duration": duration})
+    db.close()
+
+
+def test_load_devices_first_lab_wins():
+    devices = matrix.load_devices(LABNET)
+
+    assert [device["device"] for device in devices] == [
+        "device-a",
+        "device-b",
+        "device-c",
+    ]
+    assert devices[0]["proxy"] == "proxy-1"
+    assert devices[2]["proxy"] == "proxy-2"
+    assert devices[2]["snapshots_only"]
+
+
+def test_load_devices_skips_open_issues():
+    issues = ["Healthcheck failed: proxy-1/device-b", "proxy-2/device-c is down"]
+    devices = matrix.load_devices(LABNET, issues)
+
+    # devices tested on snapshots only ignore their issues
+    assert [device["device"] for device in devices] == ["device-a", "device-c"]
+
+
+def test_load_durations_median_of_window(tmp_path):
+    path = tmp_path / "history.sqlite"
+    write_history(
+        path,
+        [
+            ("device-a", "snapshot", 100),
+            ("device-a", "snapshot", 300),
+            ("device-a", "snapshot", 200),
+            ("device-a", "24.10", 50),
+        ],
+    )
+
+    assert matrix.load_durations(path) == {
+        ("device-a", "snapshot"): 200,
+        ("device-a", "24.10"): 50,
+    }
+    # only the newest runs count
+    assert matrix.load_durations(path, window=1)[("device-a", "snapshot")] == 200
+
+
+def test_load_durations_without_history(tmp_path):
+    assert matrix.load_durations(None) == {}
+    assert matrix.load_durations(tmp_path / "missing.sqlite") == {}
+
+
+def test_estimate_falls_back():
+    durations = {("device-a", "snapshot"): 100, ("device-a", "24.10"): 300}
+
+    assert matrix.estimate(durations, "device-a", "snapshot") == 100
+    assert matrix.estimate(durations, "device-a", "23.05") == 200
+    assert matrix.estimate(durations, "device-b", "snapshot") == 200
+    assert matrix.estimate({}, "device-b", "snapshot") == matrix.DEFAULT_DURATION
+
+
+def test_batch_jobs_longest_first(tmp_path):
+    path = tmp_path / "history.sqlite"
+    write_history(
+        path,
+        [
+            ("device-a", "snapshot", 100),
+            ("device-a", "24.10", 100),
+            ("device-b", "snapshot", 600),
+            ("device-b", "24.10", 400),
+            ("device-c", "snapshot", 300),
+            ("device-c", "24.10", 300),
+        ],
+    )
+    devices = matrix.load_devices(LABNET)
+
+    jobs = matrix.batch_jobs(devices, VERSIONS, matrix.load_durations(path))
+
+    assert [job["device"] for job in jobs] == ["device-b", "device-c", "device-a"]
+    assert [job["duration"] for job in jobs] == [
+        matrix.JOB_OVERHEAD + 1000,
+        matrix.JOB_OVERHEAD + 600,
+        matrix.JOB_OVERHEAD + 200,
+    ]
+    # every job runs all versions of its device
+    assert all(job["versions"] == VERSIONS for job in jobs)
+
+
+def test_batch_jobs_ties_ordered_by_name():
+    devices = matrix.load_devices(LABNET)
+
+    jobs = matrix.batch_jobs(devices, VERSIONS, {})
+
+    assert [job["device"] for job in jobs] == ["device-a", "device-b", "device-c"]
+
+
+def test_fake_coordinator_serializes_a_place():
+    coordinator = matrix.FakeCoordinator()
+
+    assert coordinator.reserve("device-a", 0, 100) == 0
+    assert coordinator.reserve("device-b", 10, 50) == 10
+    assert coordinator.reserve("device-a", 20, 100) == 100
+
+
+def test_simulate():
+    jobs = [
+        {"device": "device-a", "duration": 300},
+        {"device": "device-b", "duration": 200},
+        {"device": "device-c", "duration": 100},
+        {"device": "device-d", "duration": 100},
+    ]
+
+    assert matrix.simulate(jobs, 1) == 700
+    assert matrix.simulate(jobs, 2) == 400
+    assert matrix.simulate(jobs, 4) == 300
+
+
+def test_simulate_waits_for_the_place():
+    jobs = [
+        {"device": "device-a", "duration": 300},
+        {"device": "device-a", "duration": 300},
+    ]
+
+    # the second runner waits for the reservation of the first one
+    assert matrix.simulate(jobs, 2) == 600
+
+
+def test_longest_first_is_faster():
+    jobs = [{"device": f"device-{i}", "duration": 100} for i in range(4)]
+    jobs.append({"device": "device-long", "duration": 400})
+
+    longest_first = sorted(jobs, key=lambda job: -job["duration"])
+    assert matrix.simulate(longest_first, 2) < matrix.simulate(jobs, 2)
@@ -0,0 +1,83 @@
+"""Boot helpers shared by the strategies of this repository
+
+labgrid loads the imports of an environment in order, so this file has to be
+imported before the strategies using it.
+"""
+
+import os
+import time
+
+from labgrid.step import step
+from pexpect import TIMEOUT
+
+IMAGE_HASH_FILE = "/tmp/.labgrid-image-sha256"
+
+
+class BootMixin:
+    """Boot timings and image reuse of the strategies
+
+    boot_timings maps every phase to the seconds passed since boot_start.
+    After a full boot the strategies write the SHA256 of the image to
+    IMAGE_HASH_FILE on the DUT, see running_image_matches.
+    """
+
+    def record_timing(self, phase):
+        """Record the seconds passed since the boot started"""
+        self.boot_timings[phase] = round(time.monotonic() - self.boot_start, 3)
+
+    def await_login_prompt(self, kernel_seen=False):
+        """Wait for the login prompt, recording the kernel start on the way
+
+        Pass kernel_seen if the caller already consumed the kernel banner,
+        like UBootDriver.await_boot does.
+        """
+        console = self.shell.console
+        prompt_seen = False
+        if not kernel_seen:
+            index, _, _, _ = console.expect(
+                [r"Linux version \d", self.shell.login_prompt],
+                timeout=self.shell.login_timeout,
+            )
+            if index == 0:
+                self.record_timing("kernel")
+            prompt_seen = index == 1
+        if not prompt_seen:
+            console.expect(self.shell.login_prompt, timeout=self.shell.login_timeout)
+        self.record_timing("login_prompt")
+
+        # activate the console right away instead of letting the ShellDriver
+        # wait for await_login_timeout before it pokes the console itself
+        console.sendline("")
+
+    @step(result=True)
+    def running_image_matches(self, image_hash):
+        """Check whether the DUT already runs the image that would be booted
+
+        After every full boot the SHA256 of the image is left in /tmp on the
+        DUT. As /tmp does not survive a reboot, a match also means the DUT
+        was not reset since.
+        """
+        self.target.activate(self.console)
+        self.console.sendline("")
+        index, _, _, _ = self.console.expect(
+            [self.shell.prompt, self.shell.login_prompt, TIMEOUT],
+            timeout=self.shell.await_login_timeout,
+        )
+        if index == 2:
+            return False
+
+        self.target.activate(self.shell)
+        output, _, exitcode = self.shell.run(f"cat {IMAGE_HASH_FILE}")
+        matches = exitcode == 0 and output == [image_hash]
+
+        expected_version = os.environ.get("FIRMWARE_VERSION")
+        if matches and expected_version:
+            [actual_version] = self.shell.run_check(
+                "source /etc/os-release; echo $BUILD_ID"
+            )
+            matches = actual_version == expected_version
+
+        if not matches:
+            self.target.deactivate(self.shell)
+
+        return matches
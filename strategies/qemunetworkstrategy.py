@@ -13,8 +13,16 @@
 # limitations under the License.
 
 import enum
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+from pathlib import Path
 
 import attr
+from bootmixin import BootMixin
 from labgrid import step, target_factory
 from labgrid.strategy import Strategy, StrategyError
 from labgrid.util import get_free_port
@@ -26,9 +34,15 @@ class Status(enum.Enum):
     shell = 2
 
 
+DECOMPRESSORS = {
+    ".gz": ["gzip", "-dcq"],
+    ".zst": ["zstd", "-dcq"],
+}
+
+
 @target_factory.reg_driver
 @attr.s(eq=False)
-class QEMUNetworkStrategy(Strategy):
+class QEMUNetworkStrategy(BootMixin, Strategy):
     bindings = {
         "qemu": "QEMUDriver",
         "shell": "ShellDriver",
@@ -36,11 +50,31 @@ class QEMUNetworkStrategy(Strategy):
     }
 
     status = attr.ib(default=Status.unknown)
+    snapshot_dir = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+
+    workdir = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+
+    snapshot_tag = "shell"
 
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
         self.__port_forward = None
         self.__remote_port = self.ssh.networkservice.port
+        self.__resume = False
+        self.__snapshot_meta = None
+        self.__qemu_prepared = False
+        self.__tmpdir = None
+        self.boot_start = time.monotonic()
+        self.boot_timings = {}
+
+        if self.snapshot_dir is None:
+            self.snapshot_dir = os.environ.get("LG_QEMU_SNAPSHOT_DIR")
 
     @step(result=True)
     def get_remote_address(self):
@@ -77,6 +111,190 @@ class QEMUNetworkStrategy(Strategy):
                 networkservice.address = lan_address
                 networkservice.port = self.__remote_port
 
+    def create_image(self, path, backing=None, size=None):
+        cmd = [self.target.env.config.get_tool("qemu-img"), "create", "-f", "qcow2"]
+        if backing is not None:
+            backing_format = "qcow2" if backing.endswith(".qcow2") else "raw"
+            cmd += ["-F", backing_format, "-b", backing]
+        cmd.append(str(path))
+        if size is not None:
+            cmd.append(size)
+
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+
+    def use_disk(self, path):
+        self.target.env.config.data["images"]["qemu-overlay"] = str(path)
+        self.qemu.disk = "qemu-overlay"
+
+    @step(args=["source"])
+    def decompress_image(self, source, destination):
+        """Decompress source to destination while it is being read
+
+        Decompression runs in a separate process and blocks of zeros are
+        skipped, which keeps the destination sparse.
+        """
+        process = subprocess.Popen(
+            DECOMPRESSORS[Path(source).suffix] + [source], stdout=subprocess.PIPE
+        )
+        with process, open(destination, "wb") as image_file:
+            while chunk := process.stdout.read(1024 * 1024):
+                if chunk.count(0) == len(chunk):
+                    image_file.seek(len(chunk), os.SEEK_CUR)
+                else:
+                    image_file.write(chunk)
+            image_file.truncate()
+
+        # gzip warns about the metadata appended to OpenWrt images
+        if process.returncode not in (0, 2):
+            raise StrategyError(f"failed to decompress {source}")
+
+    def get_compressed_images(self):
+        images = {}
+        for attribute in ("disk", "kernel"):
+            image = getattr(self.qemu, attribute)
+            if image is None:
+                continue
+
+            path = self.target.env.config.get_image_path(image)
+            if Path(path).suffix in DECOMPRESSORS:
+                images[attribute] = path
+
+        return images
+
+    def use_decompressed_images(self, directory, decompress=True):
+        """Boot the decompressed versions of compressed images from directory"""
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        for attribute, path in self.get_compressed_images().items():
+            destination = Path(directory) / Path(path).stem
+            if decompress:
+                self.decompress_image(path, destination)
+
+            self.target.env.config.data["images"][f"qemu-{attribute}"] = str(
+                destination
+            )
+            setattr(self.qemu, attribute, f"qemu-{attribute}")
+
+    @step()
+    def prepare_overlay(self):
+        """Boot the disk image through a private qcow2 overlay in workdir
+
+        This keeps the firmware image untouched and allows several QEMU
+        instances to boot the same image at the same time.
+        """
+        workdir = Path(self.workdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        overlay = workdir / f"{self.target.name}.qcow2"
+        overlay.unlink(missing_ok=True)
+
+        image_path = self.target.env.config.get_image_path(self.qemu.disk)
+        self.create_image(overlay, backing=os.path.abspath(image_path))
+        self.use_disk(overlay)
+
+    def get_snapshot_fingerprint(self):
+        """Describe everything a saved VM state depends on
+
+        A snapshot is only valid for the exact firmware image and QEMU
+        command line it was taken with, so any change here invalidates it.
+        """
+        image = self.qemu.disk or self.qemu.kernel
+        image_path = self.target.env.config.get_image_path(image)
+
+        sha256 = hashlib.sha256()
+        with open(image_path, "rb") as image_file:
+            for chunk in iter(lambda: image_file.read(1024 * 1024), b""):
+                sha256.update(chunk)
+
+        return {
+            "image": os.path.abspath(image_path),
+            "sha256": sha256.hexdigest(),
+            "qemu_bin": self.target.env.config.get_tool(self.qemu.qemu_bin),
+            "machine": self.qemu.machine,
+            "cpu": self.qemu.cpu,
+            "memory": self.qemu.memory,
+            "extra_args": self.qemu.extra_args,
+            "nic": self.qemu.nic,
+        }
+
+    @step()
+    def prepare_snapshot(self):
+        """Set up the qcow2 image holding the VM state and decide whether to resume
+
+        Disk based targets boot from a qcow2 overlay on top of the firmware
+        image, so the snapshot covers the disk as well. Kernel only targets
+        get an otherwise unused qcow2 drive to store the VM state in.
+        """
+        snapshot_dir = Path(self.snapshot_dir)
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        snapshot_image = snapshot_dir / f"{self.target.name}.qcow2"
+        snapshot_meta = snapshot_dir / f"{self.target.name}.json"
+
+        fingerprint = self.get_snapshot_fingerprint()
+        decompressed = [
+            snapshot_dir / Path(path).stem
+            for path in self.get_compressed_images().values()
+        ]
+
+        try:
+            self.__resume = (
+                snapshot_image.exists()
+                and all(path.exists() for path in decompressed)
+                and json.loads(snapshot_meta.read_text()) == fingerprint
+            )
+        except (OSError, json.JSONDecodeError):
+            self.__resume = False
+
+        self.use_decompressed_images(snapshot_dir, decompress=not self.__resume)
+
+        if not self.__resume:
+            self.logger.info("No valid snapshot found, doing a cold boot")
+            snapshot_meta.unlink(missing_ok=True)
+            snapshot_image.unlink(missing_ok=True)
+
+            if self.qemu.disk:
+                image_path = self.target.env.config.get_image_path(self.qemu.disk)
+                self.create_image(snapshot_image, backing=os.path.abspath(image_path))
+            else:
+                self.create_image(snapshot_image, size="16M")
+
+        extra_args = [self.qemu.extra_args] if self.qemu.extra_args else []
+        if self.qemu.disk:
+            self.use_disk(snapshot_image)
+        else:
+            extra_args.append(
+                f"-drive if=none,id=snapshot,format=qcow2,file={snapshot_image}"
+            )
+
+        if self.__resume:
+            extra_args.append(f"-loadvm {self.snapshot_tag}")
+
+        self.qemu.extra_args = " ".join(extra_args)
+        self.__snapshot_meta = (snapshot_meta, fingerprint)
+
+    @step()
+    def save_snapshot(self):
+        snapshot_meta, fingerprint = self.__snapshot_meta
+        self.qemu.monitor_command(
+            "human-monitor-command",
+            {"command-line": f"savevm {self.snapshot_tag}"},
+        )
+        snapshot_meta.write_text(json.dumps(fingerprint, indent=2))
+
+    def activate_qemu(self):
+        # the QEMU command line is fixed on activation, prepare the disks first
+        if not self.__qemu_prepared:
+            if self.snapshot_dir:
+                self.prepare_snapshot()
+            else:
+                if self.get_compressed_images():
+                    if self.workdir is None:
+                        self.__tmpdir = tempfile.TemporaryDirectory(prefix="qemu-")
+                    self.use_decompressed_images(self.workdir or self.__tmpdir.name)
+                if self.workdir and self.qemu.disk:
+                    self.prepare_overlay()
+            self.__qemu_prepared = True
+
+        self.target.activate(self.qemu)
+
     @step(args=["state"])
     def transition(self, state, *, step):
         if not isinstance(state, Status):
@@ -90,13 +308,25 @@ class QEMUNetworkStrategy(Strategy):
             return
 
         if state == Status.off:
-            self.target.activate(self.qemu)
+            self.activate_qemu()
             self.qemu.off()
 
         elif state == Status.shell:
-            self.target.activate(self.qemu)
+            self.activate_qemu()
+            self.boot_start = time.monotonic()
+            self.boot_timings = {}
             self.qemu.on()
+            self.record_timing("power_on")
+            if self.__resume:
+                # the restored console sits idle at a prompt, poke it
+                self.qemu.sendline("")
+            else:
+                self.await_login_prompt()
             self.target.activate(self.shell)
             self.update_network_service()
+            self.record_timing("shell")
+
+            if self.snapshot_dir and not self.__resume:
+                self.save_snapshot()
 
         self.status = state
@@ -1,9 +1,83 @@
 import enum
+import json
+import os
+import subprocess
+import time
 
 import attr
+from bootmixin import IMAGE_HASH_FILE, BootMixin
 from labgrid.driver import USBSDMuxDriver, USBStorageDriver
 from labgrid.factory import target_factory
+from labgrid.step import step
 from labgrid.strategy.common import Strategy, StrategyError
+from labgrid.util.managedfile import ManagedFile
+
+# Runs next to the SD card, on the exporter for remote places. Compressed
+# images are decompressed by a separate process while writing. In differential
+# mode only blocks differing from the image are written. The written blocks are
+# read back from the card and compared to the hashes of what was written.
+WRITE_SCRIPT = """
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+image, device, block_size, differential = sys.argv[1:5]
+block_size = int(block_size)
+differential = differential == "1"
+
+decompressors = {
+    ".gz": ["gzip", "-dcq"],
+    ".zst": ["zstd", "-dcq"],
+}
+
+deadline = time.monotonic() + 30
+while not os.path.exists(device):
+    if time.monotonic() > deadline:
+        sys.exit(f"{device} did not appear")
+    time.sleep(0.5)
+
+decompressor = decompressors.get(os.path.splitext(image)[1])
+if decompressor:
+    process = subprocess.Popen(decompressor + [image], stdout=subprocess.PIPE)
+    src = process.stdout
+else:
+    process = None
+    src = open(image, "rb")
+
+written = []
+start = time.monotonic()
+with src, open(device, "r+b", buffering=0) as dst:
+    size = 0
+    while block := src.read(block_size):
+        if not differential or dst.read(len(block)) != block:
+            dst.seek(size)
+            dst.write(block)
+            written.append((size, len(block), hashlib.sha256(block).digest()))
+        size += len(block)
+        dst.seek(size)
+    os.fsync(dst.fileno())
+    duration = time.monotonic() - start
+
+    if process is not None and process.wait() not in (0, 2):
+        sys.exit(f"failed to decompress {image}")
+
+    os.posix_fadvise(dst.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    for offset, length, digest in written:
+        dst.seek(offset)
+        if hashlib.sha256(dst.read(length)).digest() != digest:
+            sys.exit(f"verification failed at offset {offset}")
+
+print(json.dumps({
+    "image_bytes": size,
+    "written_bytes": sum(length for _, length, _ in written),
+    "duration": duration,
+}))
+"""
+
+COMPRESSED_SUFFIXES = (".gz", ".zst")
 
 
 class Status(enum.Enum):
@@ -14,7 +88,7 @@ class Status(enum.Enum):
 
 @target_factory.reg_driver
 @attr.s(eq=False)
-class SDMuxStrategy(Strategy):
+class SDMuxStrategy(BootMixin, Strategy):
     """UbootStrategy - Strategy to switch to uboot or shell"""
 
     bindings = {
@@ -26,9 +100,71 @@ class SDMuxStrategy(Strategy):
     }
 
     status = attr.ib(default=Status.unknown)
+    differential = attr.ib(default=False, validator=attr.validators.instance_of(bool))
+    block_size = attr.ib(
+        default=1024 * 1024, validator=attr.validators.instance_of(int)
+    )
+    # skip booting if the DUT still runs the image from a previous boot
+    reuse = attr.ib(default=False, validator=attr.validators.instance_of(bool))
 
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
+        self.boot_start = time.monotonic()
+        self.boot_timings = {}
+        self.flash_stats = {}
+        if os.environ.get("LG_REUSE_IMAGE"):
+            self.reuse = True
+
+    @step(args=["filename"])
+    def write_image_blockwise(self, filename):
+        """Write filename to the SD card block by block
+
+        This allows to decompress images while they are written and, in
+        differential mode, to skip blocks that are already on the card. The
+        card is compared against the image on every run instead of keeping a
+        manifest of what was written last time, as the DUT writes to its card
+        while running tests.
+        """
+        resource = self.storage.storage
+        managed_file = ManagedFile(filename, resource)
+        managed_file.sync_to_resource()
+
+        output = subprocess.run(
+            resource.command_prefix
+            + [
+                "python3",
+                "-",
+                managed_file.get_remote_path(),
+                resource.path,
+                str(self.block_size),
+                "1" if self.differential else "0",
+            ],
+            input=WRITE_SCRIPT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        stats = json.loads(output)
+
+        written = stats["written_bytes"]
+        skipped = stats["image_bytes"] - written
+        # estimate the time saved from the throughput of this write
+        if written:
+            saved = skipped / (written / stats["duration"])
+        else:
+            saved = 0.0
+
+        self.flash_stats = {
+            "written_bytes": written,
+            "skipped_bytes": skipped,
+            "saved_seconds": round(saved, 1),
+        }
+        self.logger.info(
+            "Wrote %d of %d bytes, saved about %.1f seconds",
+            written,
+            stats["image_bytes"],
+            saved,
+        )
 
     def transition(self, status):
         if not isinstance(status, Status):
@@ -38,21 +174,46 @@ class SDMuxStrategy(Strategy):
         elif status == self.status:
             return  # nothing to do
         elif status == Status.shell:
+            image = self.target.env.config.get_image_path("root")
+            image_hash = ManagedFile(image, self.storage.storage).get_hash()
+
+            self.boot_start = time.monotonic()
+            self.boot_timings = {}
+            if (
+                self.reuse
+                and self.status == Status.unknown
+                and self.running_image_matches(image_hash)
+            ):
+                self.logger.info("DUT already runs %s, skipping boot", image)
+                self.record_timing("shell")
+                self.status = status
+                return
+
             self.target.activate(self.power)
             self.target.activate(self.storage)
             self.target.activate(self.sdmux)
+            self.target.activate(self.console)
             # power off
             self.power.off()
+            self.record_timing("power_off")
             # configure sd-mux
             self.sdmux.set_mode("host")
 
-            self.storage.write_image(self.target.env.config.get_image_path("root"))
+            if self.differential or image.endswith(COMPRESSED_SUFFIXES):
+                self.write_image_blockwise(image)
+            else:
+                self.storage.write_image(image)
+            self.record_timing("flashed")
 
             self.sdmux.set_mode("dut")
             # cycle power
             self.power.on()
+            self.record_timing("power_on")
 
+            self.await_login_prompt()
             self.target.activate(self.shell)
+            self.record_timing("shell")
+            self.shell.run_check(f"echo {image_hash} > {IMAGE_HASH_FILE}")
         else:
             raise StrategyError(f"no transition found from {self.status} to {status}")
         self.status = status
@@ -1,11 +1,19 @@
 import enum
 import ipaddress
+import os
+import re
+import time
 
 import attr
+from bootmixin import IMAGE_HASH_FILE, BootMixin
 from labgrid.driver import TFTPProviderDriver
 from labgrid.factory import target_factory
+from labgrid.resource.common import NetworkResource
 from labgrid.resource.remote import RemoteTFTPProvider
+from labgrid.step import step
 from labgrid.strategy.common import Strategy, StrategyError
+from labgrid.util.managedfile import ManagedFile, ManagedFileError
+from labgrid.util.ssh import sshmanager
 
 
 class Status(enum.Enum):
@@ -17,7 +25,7 @@ class Status(enum.Enum):
 
 @target_factory.reg_driver
 @attr.s(eq=False)
-class UBootTFTPStrategy(Strategy):
+class UBootTFTPStrategy(BootMixin, Strategy):
     """UbootStrategy - Strategy to switch to uboot or shell"""
 
     bindings = {
@@ -30,9 +38,102 @@ class UBootTFTPStrategy(Strategy):
     tftp: TFTPProviderDriver
 
     status = attr.ib(default=Status.unknown)
+    # free space to keep on the exporter when caching staged images
+    cache_reserve = attr.ib(
+        default=256 * 1024 * 1024, validator=attr.validators.instance_of(int)
+    )
+    # minutes an image stays in the cache after it was last staged
+    cache_min_age = attr.ib(default=60, validator=attr.validators.instance_of(int))
+    # skip booting if the DUT still runs the image from a previous boot
+    reuse = attr.ib(default=False, validator=attr.validators.instance_of(bool))
 
     def __attrs_post_init__(self):
         super().__attrs_post_init__()
+        self.boot_start = time.monotonic()
+        self.boot_timings = {}
+        self._managed_file = None
+        if os.environ.get("LG_REUSE_IMAGE"):
+            self.reuse = True
+
+    def evict_cache(self, conn, cache_path, required):
+        """Remove least recently staged images until required bytes fit"""
+        while True:
+            available = int(
+                conn.run_check(f"df -Pk {cache_path} | tail -1")[0].split()[3]
+            )
+            if available * 1024 >= required + self.cache_reserve:
+                return
+
+            entries = conn.run_check(
+                f"find {cache_path} -mindepth 1 -maxdepth 1 -type d "
+                f"-mmin +{self.cache_min_age} -printf '%T@ %p\\n' | sort -n"
+            )
+            entries = [
+                path
+                for _, path in (entry.split(" ", 1) for entry in entries)
+                if re.fullmatch(r"[0-9a-f]{64}", os.path.basename(path))
+            ]
+            if not entries:
+                self.logger.warning("Nothing left to evict from %s", cache_path)
+                return
+
+            self.logger.info("Evicting %s from the TFTP cache", entries[0])
+            conn.run_check(f"rm -rf {entries[0]}")
+
+    def managed_file(self, filename):
+        """ManagedFile of filename, which is only hashed again once it changed"""
+        stat = os.stat(filename)
+        key = (os.path.realpath(filename), stat.st_mtime_ns, stat.st_size)
+        if self._managed_file is None or self._managed_file[0] != key:
+            self._managed_file = (key, ManagedFile(filename, self.tftp.provider))
+        return self._managed_file[1]
+
+    @step(args=["filename"], result=True)
+    def stage(self, filename):
+        """Stage filename for TFTP, skipping the upload if the exporter has it
+
+        Stages like TFTPProviderDriver.stage, which uploads images through
+        ManagedFile below a directory named after their SHA256 hash. If that
+        directory already holds the image, only its timestamp is refreshed
+        and the link is updated. Before an upload the least recently used
+        images are evicted if disk space runs low.
+        """
+        provider = self.tftp.provider
+        if not isinstance(provider, NetworkResource):
+            return self.tftp.stage(filename)
+
+        symlink = os.path.join(provider.internal, os.path.basename(filename))
+        assert symlink.startswith(provider.internal)
+        staged = provider.external + symlink[len(provider.internal) :]
+
+        managed_file = self.managed_file(filename)
+        cache_path = managed_file.get_user_cache_path()
+        image_path = f"{cache_path}/{managed_file.get_hash()}"
+        remote_file = f"{image_path}/{os.path.basename(filename)}"
+
+        conn = sshmanager.open(provider.host)
+        # an interrupted upload leaves a truncated file behind
+        size = os.path.getsize(filename)
+        cached = conn.run(
+            f'[ "$(stat -c %s {remote_file})" = {size} ] && touch {image_path}'
+        )
+        if cached[2] != 0:
+            conn.run_check(f"mkdir -p {cache_path}")
+            self.evict_cache(conn, cache_path, size)
+            # skips the upload if the exporter reaches the image via NFS
+            managed_file.sync_to_resource(symlink=symlink)
+            return staged
+
+        self.logger.info("%s is already cached on %s", filename, provider.host)
+        # the same checks as ManagedFile.sync_to_resource
+        if conn.run(f"test ! -e {symlink} -o -L {symlink}")[2] != 0:
+            raise ManagedFileError(f"Path {symlink} exists but is not a symlink.")
+        # short options are compatible with busybox
+        conn.run_check(
+            f"mkdir -p {os.path.dirname(symlink)} && ln -sfn {remote_file} {symlink}"
+        )
+
+        return staged
 
     def transition(self, status):
         if not isinstance(status, Status):
@@ -44,18 +145,23 @@ class UBootTFTPStrategy(Strategy):
         elif status == Status.off:
             self.target.deactivate(self.console)
             self.target.activate(self.power)
+            self.boot_start = time.monotonic()
+            self.boot_timings = {}
             self.power.off()
+            self.record_timing("power_off")
         elif status == Status.uboot:
             self.transition(Status.off)
             self.target.activate(self.tftp)
             self.target.activate(self.console)
 
-            staged_file = self.tftp.stage(self.target.env.config.get_image_path("root"))
+            staged_file = self.stage(self.target.env.config.get_image_path("root"))
+            self.record_timing("staged")
             tftp_server_ip = self.target.get_resource(
                 RemoteTFTPProvider, wait_avail=False
             ).external_ip
 
             self.power.cycle()
+            self.record_timing("power_on")
             # interrupt uboot
 
             self.uboot.init_commands = (
@@ -69,14 +175,46 @@ class UBootTFTPStrategy(Strategy):
                     f"setenv ipaddr {tftp_dut_ip}",
                 ) + self.uboot.init_commands
 
-            self.target.activate(self.uboot)
+            # run the init commands, which usually load the image via TFTP,
+            # separately to tell the U-Boot prompt and the transfer apart
+            init_commands = self.uboot.init_commands
+            self.uboot.init_commands = ()
+            try:
+                self.target.activate(self.uboot)
+            finally:
+                self.uboot.init_commands = init_commands
+            self.record_timing("uboot")
+
+            for command in init_commands:
+                self.uboot.run_check(command)
+            self.record_timing("tftp")
         elif status == Status.shell:
+            image = self.target.env.config.get_image_path("root")
+            image_hash = self.managed_file(image).get_hash()
+
+            self.boot_start = time.monotonic()
+            self.boot_timings = {}
+            if (
+                self.reuse
+                and self.status == Status.unknown
+                and self.running_image_matches(image_hash)
+            ):
+                self.logger.info("DUT already runs %s, skipping boot", image)
+                self.record_timing("shell")
+                self.status = status
+                return
+
             # transition to uboot
             self.transition(Status.uboot)
 
             self.uboot.boot("")
+            # await_boot consumes the kernel banner
             self.uboot.await_boot()
+            self.record_timing("kernel")
+            self.await_login_prompt(kernel_seen=True)
             self.target.activate(self.shell)
+            self.record_timing("shell")
+            self.shell.run_check(f"echo {image_hash} > {IMAGE_HASH_FILE}")
         else:
             raise StrategyError(f"no transition found from {self.status} to {status}")
         self.status = status
@@ -12,35 +12,1029 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import glob
+import gzip
+import http.server
 import json
 import logging
+import math
+import os
+import re
+import secrets
+import shlex
+import shutil
+import sqlite3
+import ssl
+import statistics
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+import warnings
+from collections import deque, namedtuple
+from dataclasses import dataclass, field
 from os import getenv
+from pathlib import Path
+from types import MappingProxyType
 
 import pytest
+from labgrid.driver import ExecutionError
+from labgrid.step import steps
 
 logger = logging.getLogger(__name__)
 
+console_log_key = pytest.StashKey()
+segmented_log_key = pytest.StashKey()
+
+session_timing = {"start": None, "serial": 0.0}
+
+# properties of the session not yet added to a test report
+session_properties = []
+
 device = getenv("LG_ENV", "Unknown").split("/")[-1].split(".")[0]
 
 
 def pytest_addoption(parser):
     parser.addoption("--firmware", action="store", default="firmware.bin")
+    parser.addoption(
+        "--sample-interval",
+        action="store",
+        type=float,
+        default=0,
+        help="sample DUT resources every N seconds in the background (0: off)",
+    )
+    parser.addoption(
+        "--sample-limit",
+        action="store",
+        type=int,
+        default=10000,
+        help="number of resource samples to keep, older ones are dropped",
+    )
+    parser.addoption(
+        "--host-address",
+        action="store",
+        default=None,
+        help="address of this host as reached by a real device, for local servers",
+    )
+    parser.addoption(
+        "--feed-cache",
+        action="store",
+        default=os.path.join(
+            getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "openwrt-tests",
+            "feeds",
+        ),
+        help="directory of the local package feed",
+    )
+    parser.addoption(
+        "--timing-history",
+        action="store",
+        default=None,
+        help="history database of contrib/history.py to learn boot timeouts from",
+    )
+    parser.addoption(
+        "--console-segment-size",
+        action="store",
+        type=int,
+        default=0,
+        help="write the --lg-log console log as gzip segments of N bytes (0: off)",
+    )
+    parser.addoption(
+        "--console-segments",
+        action="store",
+        type=int,
+        default=20,
+        help="number of console log segments to keep, older ones are deleted",
+    )
 
 
+@pytest.hookimpl(tryfirst=True)
 def pytest_configure(config):
     config._metadata = getattr(config, "_metadata", {})
     config._metadata["version"] = "12.3.4"
     config._metadata["environment"] = "staging"
 
+    if config.option.lg_log:
+        # every pytest-xdist worker runs its own target, keep their logs apart
+        worker = getenv("PYTEST_XDIST_WORKER")
+        if worker:
+            config.option.lg_log = os.path.join(config.option.lg_log, worker)
+        os.makedirs(config.option.lg_log, exist_ok=True)
+
+        # labgrid starts its plain console log for --lg-log, hide the option
+        # from it while it is configured if the segmented log replaces it
+        if config.getoption("console_segment_size"):
+            config.stash[segmented_log_key] = config.option.lg_log
+            config.option.lg_log = None
+
+
+def pytest_unconfigure(config):
+    console_log = config.stash.get(console_log_key, None)
+    if console_log is not None:
+        console_log.close()
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    console_log = item.config.stash.get(console_log_key, None)
+    if console_log is not None:
+        console_log.mark("start", item.nodeid)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    report = outcome.get_result()
+    # session fixtures are torn down within the teardown of the last test
+    if call.when == "teardown" and session_properties:
+        report.user_properties.extend(session_properties)
+        session_properties.clear()
+
+    console_log = item.config.stash.get(console_log_key, None)
+    if console_log is None:
+        return
+
+    # only the console output since the test started goes into its report
+    if report.failed:
+        report.sections.append(("Captured console", console_log.test_output()))
+    if call.when == "teardown":
+        console_log.mark("end", item.nodeid)
+
+
+def pytest_sessionstart(session):
+    session_timing["start"] = time.monotonic()
+
+    config = session.config
+    path = config.stash.get(segmented_log_key, None)
+    if path is not None:
+        config.option.lg_log = path
+        config.stash[console_log_key] = SegmentedConsoleLog(
+            path,
+            config.getoption("console_segment_size"),
+            config.getoption("console_segments"),
+        )
+
+
+def pytest_runtest_logreport(report):
+    # with pytest-xdist the controller receives the reports of all workers,
+    # their summed up durations is what a serial run would have taken
+    session_timing["serial"] += report.duration
+
+
+def pytest_terminal_summary(terminalreporter):
+    # only the controller of pytest-xdist distributes the tests, and without
+    # any test run there is nothing to compare
+    distributed = terminalreporter.config.pluginmanager.has_plugin("dsession")
+    if (
+        session_timing["start"] is None
+        or not distributed
+        or not session_timing["serial"]
+    ):
+        return
+
+    wall_clock = time.monotonic() - session_timing["start"]
+    serial = session_timing["serial"]
+    terminalreporter.write_sep("-", "timing")
+    terminalreporter.write_line(
+        f"wall-clock {wall_clock:.1f}s, serial {serial:.1f}s "
+        f"(speedup {serial / wall_clock:.2f}x)"
+    )
+
+
+class SegmentedConsoleLog:
+    """Console log kept as a rolling window of gzip compressed segments
+
+    Replaces the plain --lg-log console log of labgrid. A new segment
+    console_<target>.<n>.gz is started every segment_size bytes of console
+    output and only the newest count segments are kept. The index file
+    console_<target>.index records, as JSON lines, in which segment and at
+    which offset each test started and ended. The output since the start of
+    the running test is kept, up to tail bytes, for its failure report.
+    Every write is appended to the segment as a gzip member of its own, so
+    no file stays open and the segments can be read while they are written
+    and survive a crash of pytest.
+    """
+
+    def __init__(self, path, segment_size, count, tail=256 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.count = count
+        self.tail = tail
+        self.output = bytearray()
+        self.logs = {}
+        steps.subscribe(self.notify)
+
+    def notify(self, event):
+        step = event.step
+        if (
+            step.tag == "console"
+            and step.title == "read"
+            and event.data.get("state") == "stop"
+            and step.result
+            and step.source
+        ):
+            self.write(step.source, step.result)
+
+    def write(self, source, data):
+        log = self.logs.get(source)
+        if log is None:
+            name = f"console_{source.target.name}"
+            if source.name:
+                name += f"_{source.name}"
+            log = self.logs[source] = {
+                "name": os.path.join(self.path, name),
+                "segment": -1,
+                "offset": 0,
+            }
+        if log["segment"] < 0 or log["offset"] >= self.segment_size:
+            self.rotate(log)
+
+        with gzip.open(f"{log['name']}.{log['segment']:04d}.gz", "ab") as f:
+            f.write(data)
+        log["offset"] += len(data)
+
+        self.output += data
+        if len(self.output) > self.tail:
+            del self.output[: -self.tail]
+
+    def rotate(self, log):
+        log["segment"] += 1
+        log["offset"] = 0
+
+        expired = f"{log['name']}.{log['segment'] - self.count:04d}.gz"
+        if os.path.exists(expired):
+            os.remove(expired)
+
+    def mark(self, event, test):
+        if event == "start":
+            self.output.clear()
+
+        for log in self.logs.values():
+            entry = {
+                "time": round(time.time(), 3),
+                "event": event,
+                "test": test,
+                "segment": log["segment"],
+                "offset": log["offset"],
+            }
+            with open(f"{log['name']}.index", "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def test_output(self):
+        return self.output.decode(errors="replace")
+
+    def close(self):
+        steps.unsubscribe(self.notify)
+
+
+def read_console(path, name):
+    """Return the console log console_<name> in path, plain or segmented"""
+    plain = os.path.join(path, name)
+    if os.path.exists(plain):
+        with open(plain, "rb") as f:
+            return f.read().decode(errors="replace")
+
+    data = b""
+    for segment in sorted(glob.glob(f"{glob.escape(plain)}.*.gz")):
+        with gzip.open(segment) as f:
+            data += f.read()
+    return data.decode(errors="replace")
+
+
+class UbusError(Exception):
+    """A ubus call failed, status is the ubus status code of the failure"""
+
+    STATUS = MappingProxyType(
+        {
+            1: "invalid command",
+            2: "invalid argument",
+            3: "method not found",
+            4: "not found",
+            5: "no data",
+            6: "permission denied",
+            7: "timeout",
+            8: "not supported",
+            9: "unknown error",
+            10: "connection failed",
+            11: "out of memory",
+            12: "parse error",
+            13: "system error",
+        }
+    )
+
+    def __init__(self, path, method, status, message=None):
+        self.path = path
+        self.method = method
+        self.status = status
+        self.message = message or self.STATUS.get(status, f"status {status}")
+        super().__init__(f"ubus call {path} {method} failed: {self.message}")
+
+
+class UbusClient:
+    """Run ubus calls on the DUT over a shell or SSH connection
+
+    Several calls are sent in a single exchange with call_many(). Results of
+    calls which do not change while the DUT is running are cached.
+    """
+
+    STATIC = frozenset({("system", "board")})
+
+    def __init__(self, command):
+        self.command = command
+        self.cache = {}
+
+    @staticmethod
+    def key(path, method, params):
+        return (path, method, json.dumps(params or {}, sort_keys=True))
+
+    def parse(self, path, method, result):
+        if result.exitcode != 0:
+            raise UbusError(path, method, result.exitcode)
+
+        try:
+            return json.loads("\n".join(result.stdout) or "{}")
+        except json.JSONDecodeError as e:
+            raise UbusError(path, method, 12, f"invalid JSON: {e}") from e
+
+    def call_many(self, calls, timeout=30):
+        """Run the (path, method[, params]) calls, return their results
+
+        Raises UbusError for the first failed call.
+        """
+        calls = [(call[0], call[1], (call[2:] or [None])[0]) for call in calls]
+        keys = [self.key(*call) for call in calls]
+        pending = {key: call for key, call in zip(keys, calls) if key not in self.cache}
+
+        commands = [
+            f"ubus -t {timeout} call {path} {method} {shlex.quote(json.dumps(params or {}))}"
+            for path, method, params in pending.values()
+        ]
+        results = dict(
+            zip(pending, run_batch(self.command, commands, timeout=timeout + 10))
+        )
+
+        outputs = []
+        for key in keys:
+            if key in self.cache:
+                outputs.append(self.cache[key])
+                continue
+
+            path, method, _ = key
+            output = self.parse(path, method, results[key])
+            if (path, method) in self.STATIC:
+                self.cache[key] = output
+            outputs.append(output)
+
+        return outputs
+
+    def call(self, path, method, params=None, timeout=30):
+        [output] = self.call_many([(path, method, params)], timeout)
+        return output
+
+
+CommandResult = namedtuple("CommandResult", ["stdout", "stderr", "exitcode"])
+
+
+def run_batch(command, commands, timeout=30, max_length=2048):
+    """Run several commands on the DUT in a single exchange
+
+    Works with both the shell_command and ssh_command fixtures. Returns a
+    CommandResult per command, in the same order, with stdout and stderr
+    kept apart even on a serial console. Batches longer than max_length
+    characters are split, as console input lines are limited in length.
+    """
+    if not commands:
+        return []
+
+    marker = f"@@{secrets.token_hex(4)}"
+    prologue = (
+        f"m={marker};d=$(mktemp -d);"
+        'b(){ (eval "$1") >$d/o 2>$d/e;printf "\\n$m %d\\n" $?;'
+        'cat $d/o;printf "\\n$m\\n";cat $d/e;};'
+    )
+    epilogue = 'printf "\\n$m\\n";rm -r $d'
+
+    batches = [[]]
+    length = len(prologue) + len(epilogue)
+    for cmd in commands:
+        call = f"b {shlex.quote(cmd)};"
+        if batches[-1] and length + len(call) > max_length:
+            batches.append([])
+            length = len(prologue) + len(epilogue)
+        batches[-1].append(call)
+        length += len(call)
+
+    results = []
+    for batch in batches:
+        output, _, _ = command.run(
+            prologue + "".join(batch) + epilogue, timeout=timeout
+        )
+
+        # every segment is followed by a newline printed before the next
+        # marker, drop it to get the output of the command itself
+        segments = [[]]
+        for line in output:
+            if line.startswith(marker):
+                if segments[-1] and segments[-1][-1] == "":
+                    segments[-1].pop()
+                segments.append([line[len(marker) :].strip()])
+            else:
+                segments[-1].append(line)
+
+        # segments are: header with exit code and stdout, stderr, ...
+        for header, stderr in zip(segments[1::2], segments[2::2]):
+            results.append(CommandResult(header[1:], stderr[1:], int(header[0])))
+
+    return results
+
+
+def timed_wait(what, command, cmd, timeout):
+    """Run a blocking command on the DUT, return the seconds it took or None"""
+    start = time.monotonic()
+    _, _, exitcode = command.run(cmd, timeout=timeout + 10)
+    elapsed = round(time.monotonic() - start, 3)
+
+    if exitcode != 0:
+        logger.warning("Waited %.1fs for %s without success", elapsed, what)
+        return None
+
+    logger.info("Waited %.1fs for %s", elapsed, what)
+    return elapsed
+
+
+def wait_for_ubus_object(command, path, timeout=60):
+    """Wait until the ubus object path is registered"""
+    return timed_wait(path, command, f"ubus -t {timeout} wait_for {path}", timeout)
+
+
+def wait_for_ubus_event(command, event, condition, timeout=60, what=None):
+    """Wait until the shell condition holds on the DUT
+
+    The condition is checked once and then again whenever ubus sees an event
+    of the given type. Everything runs in a single command, nothing is polled.
+    """
+    cmd = (
+        "("
+        "f=$(mktemp -u); mkfifo $f; "
+        f"ubus -t {timeout} listen {event} > $f & l=$!; "
+        "exec 3< $f; rm $f; "
+        f"r=1; if {condition}; then r=0; "
+        f"else while read -r _ <&3; do if {condition}; then r=0; break; fi; done; "
+        "fi; kill $l 2>/dev/null; exit $r"
+        ")"
+    )
+    return timed_wait(what or condition, command, cmd, timeout)
 
-def ubus_call(command, namespace, method, params={}):
-    output = command.run_check(f"ubus call {namespace} {method} '{json.dumps(params)}'")
 
+def wait_for_interface(command, interface, timeout=60):
+    """Wait until netifd assigned an IPv4 address to interface"""
+    condition = (
+        f"ubus call network.interface.{interface} status 2>/dev/null "
+        "| jsonfilter -e '@[\"ipv4-address\"][0].address' | grep -q ."
+    )
+    return wait_for_ubus_event(
+        command, "network.interface", condition, timeout, f"interface {interface}"
+    )
+
+
+def wait_for_ubus_object_removal(command, path, timeout=60):
+    """Wait until the ubus object path is gone"""
+    return wait_for_ubus_event(
+        command,
+        "ubus.object.remove",
+        f"! ubus list {path} >/dev/null 2>&1",
+        timeout,
+        f"removal of {path}",
+    )
+
+
+def restart_wifi_and_wait(ssh_command, timeout=5):
+    """
+    Helper function to restart wifi via ubus and wait for it to settle.
+
+    Args:
+        ssh_command: SSH command fixture for executing commands
+        timeout: Maximum time to wait for wifi to settle (default: 5 seconds)
+
+    Returns:
+        bool: True if wifi restarted successfully, False if timed out
+    """
+    # Restart wifi, waiting for hostapd to go away first so the old instance
+    # is not mistaken for the restarted one
+    ssh_command.run("wifi down")
+    wait_for_ubus_object_removal(ssh_command, "hostapd.phy0-ap0", timeout)
+    ssh_command.run("wifi up")
+
+    # Wait till network reload finished
+    return wait_for_ubus_object(ssh_command, "hostapd.phy0-ap0", timeout) is not None
+
+
+def wait_for_ssh(connection, timeout=120):
+    """Wait until the DUT accepts SSH connections, return the seconds it took
+
+    The SSHDriver connects through the NetworkService of the target, so QEMU
+    port forwards, proxies and the ssh options of the driver apply. ssh
+    blocks until the server accepted the connection and finished the
+    handshake. Returns 0 if the connection is already up.
+    """
+    if connection.connected:
+        return 0.0
+
+    ssh = connection.ssh
+    configured = ssh.connection_timeout
+    ssh.connection_timeout = float(timeout)
+    start = time.monotonic()
+    try:
+        connection.connect()
+    except Exception:
+        logger.warning("SSH did not come up within %ds", timeout, exc_info=True)
+        return None
+    finally:
+        ssh.connection_timeout = configured
+
+    elapsed = round(time.monotonic() - start, 3)
+    logger.info("Waited %.1fs for SSH", elapsed)
+    return elapsed
+
+
+# Name-lists of SSH_MSG_KEXINIT in the order of RFC 4253, section 7.1
+SSH_KEXINIT_LISTS = (
+    "kex_algorithms",
+    "server_host_key_algorithms",
+    "encryption_algorithms_client_to_server",
+    "encryption_algorithms_server_to_client",
+    "mac_algorithms_client_to_server",
+    "mac_algorithms_server_to_client",
+    "compression_algorithms_client_to_server",
+    "compression_algorithms_server_to_client",
+    "languages_client_to_server",
+    "languages_server_to_client",
+)
+SSH_MSG_KEXINIT = 20
+
+
+async def ssh_kexinit(host, port=22, timeout=10):
+    """Return the banner and the algorithms offered by the SSH server at host
+
+    Only the version exchange and the unencrypted SSH_MSG_KEXINIT of the
+    server are read, the connection is closed before any key exchange.
+    """
+    async with asyncio.timeout(timeout):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(b"SSH-2.0-openwrt-tests\r\n")
+
+            # servers may send other lines before their banner
+            while not (line := await reader.readline()).startswith(b"SSH-"):
+                if not line:
+                    raise ConnectionError("Connection closed before the SSH banner")
+
+            length = int.from_bytes(await reader.readexactly(4), "big")
+            if length > 35000:
+                raise ValueError(f"SSH packet of {length} bytes is too large")
+            packet = await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    payload = packet[1 : length - packet[0]]
+    if payload[0] != SSH_MSG_KEXINIT:
+        raise ValueError(f"Expected SSH_MSG_KEXINIT, got message {payload[0]}")
+
+    algorithms = {"banner": line.decode(errors="replace").strip()}
+    # message number and 16 bytes of cookie
+    offset = 17
+    for name in SSH_KEXINIT_LISTS:
+        size = int.from_bytes(payload[offset : offset + 4], "big")
+        value = payload[offset + 4 : offset + 4 + size].decode()
+        algorithms[name] = value.split(",") if value else []
+        offset += 4 + size
+    return algorithms
+
+
+async def probe_tcp(host, port, timeout=2):
+    """Return "open", "closed" or "filtered" for a TCP port of host
+
+    QEMU port forwards accept every connection and close it if nothing
+    listens in the guest, so a connection closed right away counts as
+    closed.
+    """
+    try:
+        async with asyncio.timeout(timeout):
+            reader, writer = await asyncio.open_connection(host, port)
+    except TimeoutError:
+        return "filtered"
+    except OSError:
+        return "closed"
+
+    try:
+        async with asyncio.timeout(timeout):
+            return "open" if await reader.read(1) else "closed"
+    except TimeoutError:
+        # the service waits for the client to speak first
+        return "open"
+    except OSError:
+        return "closed"
+    finally:
+        writer.close()
+
+
+async def probe_udp(host, port, timeout=2):
+    """Return "open", "closed" or "open|filtered" for a UDP port of host
+
+    A datagram with a single newline is sent, only ICMP port unreachable
+    tells that a port is closed. Most services do not answer it.
+    """
+    loop = asyncio.get_running_loop()
+    state = loop.create_future()
+
+    class Probe(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            transport.sendto(b"\n")
+
+        def datagram_received(self, data, addr):
+            if not state.done():
+                state.set_result("open")
+
+        def error_received(self, exc):
+            if not state.done():
+                state.set_result("closed")
+
+    transport, _ = await loop.create_datagram_endpoint(Probe, remote_addr=(host, port))
+    try:
+        async with asyncio.timeout(timeout):
+            return await state
+    except TimeoutError:
+        return "open|filtered"
+    finally:
+        transport.close()
+
+
+async def scan_ports(targets, timeout=2, concurrency=64):
+    """Probe the (proto, host, port) targets concurrently, return their states"""
+    semaphore = asyncio.Semaphore(concurrency)
+    probes = {"tcp": probe_tcp, "udp": probe_udp}
+
+    async def probe(proto, host, port):
+        async with semaphore:
+            return await probes[proto](host, port, timeout)
+
+    return await asyncio.gather(*(probe(*target) for target in targets))
+
+
+def listening_sockets(command):
+    """Return the sorted (proto, address, port) of the listening sockets of the DUT"""
+    sockets = set()
+    for line in command.run_check("netstat -ltun"):
+        fields = line.split()
+        if len(fields) < 4 or fields[0] not in ("tcp", "tcp6", "udp", "udp6"):
+            continue
+        address, _, port = fields[3].rpartition(":")
+        sockets.add((fields[0].rstrip("6"), address, int(port)))
+    return sorted(sockets)
+
+
+# Boot events in boot order, the earliest match of each pattern counts
+BOOT_EVENTS = {
+    "kernel_start": r"Linux version \d",
+    "rootfs_mount": r"VFS: Mounted root",
+    "kernel_init_done": r"Run \S+ as init process",
+    "preinit": r"init: - preinit -",
+    "overlay_mount": r"mount_root: switch(?:ed|ing) to",
+    "procd_early": r"procd: - early -",
+    "procd_ubus": r"procd: - ubus -",
+    "procd_init": r"procd: - init -",
+    "procd_init_complete": r"procd: - init complete -",
+    "interface_up": r"netifd: Interface '[^']+' is now up",
+    # procd runs dropbear in the foreground
+    "dropbear_start": r"dropbear\[\d+\]: (?:Not backgrounding|Running in background)",
+}
+BOOT_EVENT_RE = re.compile(
+    "|".join(f"(?P<{name}>{pattern})" for name, pattern in BOOT_EVENTS.items())
+)
+# printk timestamps have microseconds, those added by logread -t milliseconds
+PRINTK_TIMESTAMP_RE = re.compile(r"\[\s*(\d+\.\d{6})\]")
+SYSLOG_TIMESTAMP_RE = re.compile(r"\[(\d+\.\d{3})\] ")
+# Logs the uptime to syslog, logread -t adds the wall clock time in ms
+BOOT_EPOCH_COMMAND = 'read -r u _ < /proc/uptime; logger -t labgrid "uptime $u"'
+BOOT_EPOCH_RE = re.compile(r"labgrid: uptime (\d+\.\d+)")
+
+
+# How the boot timeouts are learned from the history of a device: the
+# duration of every phase in the last runs and the test expecting it
+BOOT_PHASES = {
+    "login": ("boot_power_on", "boot_login_prompt"),
+    "ssh": ("boot_shell", "boot_ssh"),
+}
+TIMEOUT_MIN_RUNS = 5
+TIMEOUT_RUNS = 50
+
+
+def learn_timeouts(path, device, margin=1.25, slack=10):
+    """Return the timeout of every boot phase learned from the history
+
+    The timeout is the 99th percentile of the duration of the phase in the
+    last runs of the device, with some margin. Phases with fewer than
+    TIMEOUT_MIN_RUNS runs are left out.
+    """
+    names = {name for phase in BOOT_PHASES.values() for name in phase}
     try:
-        return json.loads("\n".join(output))
-    except json.JSONDecodeError:
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        rows = db.execute(
+            "SELECT run_id, name, value FROM metrics WHERE run_id IN ("
+            "SELECT id FROM runs WHERE device = ? ORDER BY timestamp DESC LIMIT ?)"
+            f" AND name IN ({', '.join('?' * len(names))})",
+            (device, TIMEOUT_RUNS, *names),
+        ).fetchall()
+    except sqlite3.Error:
+        logger.warning("Could not read the timing history %s", path, exc_info=True)
         return {}
 
+    runs = {}
+    for run_id, name, value in rows:
+        runs.setdefault(run_id, {})[name] = value
+
+    timeouts = {}
+    for phase, (start, end) in BOOT_PHASES.items():
+        durations = [
+            metrics[end] - metrics[start]
+            for metrics in runs.values()
+            if start in metrics and end in metrics
+        ]
+        if len(durations) < TIMEOUT_MIN_RUNS:
+            continue
+        p99 = statistics.quantiles(durations, n=100, method="inclusive")[98]
+        timeouts[phase] = math.ceil(p99 * margin + slack)
+    return timeouts
+
+
+def boot_epoch(lines):
+    """Epoch time the DUT booted at, from the BOOT_EPOCH_COMMAND in logread -t
+
+    Returns None if the message of BOOT_EPOCH_COMMAND is not in lines.
+    """
+    for line in reversed(lines):
+        uptime = BOOT_EPOCH_RE.search(line)
+        syslog = SYSLOG_TIMESTAMP_RE.search(line)
+        if uptime and syslog:
+            return float(syslog.group(1)) - float(uptime.group(1))
+    return None
+
+
+def read_boot_logs(command):
+    """Return the lines of dmesg and logread -t and the boot_epoch of the DUT"""
+    # the uptime has to be logged before logread -t reads the syslog
+    dmesg, _, syslog = run_batch(command, ["dmesg", BOOT_EPOCH_COMMAND, "logread -t"])
+    return dmesg.stdout + syslog.stdout, boot_epoch(syslog.stdout)
+
+
+def boot_timeline(lines, boot_epoch=None):
+    """Turn log lines into a dict of boot events and seconds since boot
+
+    Lines may come from dmesg, the console log or logread -t. Kernel
+    messages carry their printk timestamp, other syslog messages are placed
+    using the epoch timestamp of logread -t and boot_epoch, the time the
+    DUT booted. Lines without a usable timestamp are ignored.
+    """
+    timeline = {}
+    for line in lines:
+        match = BOOT_EVENT_RE.search(line)
+        if not match:
+            continue
+
+        printk = PRINTK_TIMESTAMP_RE.search(line, 0, match.start())
+        syslog = SYSLOG_TIMESTAMP_RE.search(line, 0, match.start())
+        if printk:
+            seconds = float(printk.group(1))
+        elif syslog and boot_epoch is not None:
+            seconds = float(syslog.group(1)) - boot_epoch
+        else:
+            continue
+
+        event = match.lastgroup
+        if event not in timeline or seconds < timeline[event]:
+            timeline[event] = round(seconds, 3)
+
+    return {event: timeline[event] for event in BOOT_EVENTS if event in timeline}
+
+
+KERNEL_ERROR_PATTERNS = [
+    r" Oops:",  # don't trigger on "ramoops"
+    r"(PC is at |pc : )([^+\[ ]+)",
+    r"BUG:",
+    r"corruption",
+    r"do_page_fault\(\): sending",
+    r"EIP: \[<.*>\] ([^+ ]+)",
+    r"epc\s+:\s+\S+\s+([^+ ]+)",
+    r"\berror\b.*\bat\b",
+    r"hung task",
+    r"Kernel panic",
+    r"Out of memory",
+    r"segfault",
+    r"stack overflow",
+    r"traps:.*general protection",
+    r"Unable to handle kernel",
+]
+KERNEL_ERROR_RE = re.compile("|".join(f"(?:{p})" for p in KERNEL_ERROR_PATTERNS))
+
+
+def kernel_errors(lines):
+    """Lines of a kernel log matching any of the KERNEL_ERROR_PATTERNS"""
+    return [line for line in lines if KERNEL_ERROR_RE.search(line)]
+
+
+class KernelErrorWarning(UserWarning):
+    """The kernel logged an error during a test"""
+
+
+class KernelLog:
+    """Read the kernel log of the DUT incrementally
+
+    The cursor is the printk timestamp of the newest line seen so far and
+    the number of lines seen with that timestamp, as several lines may share
+    it. Lines up to the cursor are filtered out on the DUT, so only new
+    lines are transferred and checked. The cursor belongs to the boot_id of
+    the kernel, after a reboot the log of the new boot is read from its
+    start again.
+    """
+
+    def __init__(self):
+        self.boot_id = None
+        self.cursor = None
+
+    def read(self, command):
+        """Return whether the DUT booted since the last read and the new lines"""
+        timestamp, seen = self.cursor or (-1, 0)
+        stdout = command.run_check(
+            "read -r b < /proc/sys/kernel/random/boot_id; echo $b; "
+            f'[ "$b" = "{self.boot_id}" ] && c={timestamp} k={seen} || c=-1 k=0; '
+            "dmesg | awk -v c=$c -v k=$k "
+            '\'{ t = substr($0, 2, index($0, "]") - 2) + 0 } '
+            "t > c || (t == c && ++n > k)'"
+        )
+        boot_id, lines = stdout[0], stdout[1:]
+        booted = boot_id != self.boot_id
+        if booted:
+            self.boot_id, self.cursor = boot_id, None
+
+        timestamps = [
+            match.group(1) for match in map(PRINTK_TIMESTAMP_RE.match, lines) if match
+        ]
+        if timestamps:
+            last = timestamps[-1]
+            seen = timestamps.count(last)
+            if self.cursor and self.cursor[0] == last:
+                seen += self.cursor[1]
+            self.cursor = (last, seen)
+        return booted, lines
+
+    def check(self, command):
+        """Return the errors in the lines logged since the last check
+
+        The log of a new boot only moves the cursor, errors logged while
+        booting are reported by test_kernel_errors.
+        """
+        booted, lines = self.read(command)
+        return [] if booted else kernel_errors(lines)
+
+
+@dataclass
+class DeviceFacts:
+    """Snapshot of the state of the DUT, see collect_facts()"""
+
+    board: dict
+    cpu_count: int | None = None
+    uptime: float | None = None
+    load: tuple | None = None
+    memory: dict = field(default_factory=dict)
+    mounts: dict = field(default_factory=dict)
+    thermal: dict = field(default_factory=dict)
+    interfaces: dict = field(default_factory=dict)
+    file_descriptors: dict = field(default_factory=dict)
+    entropy: int | None = None
+    process_count: int | None = None
+    package_manager: str | None = None
+
+    def counters(self):
+        """Flat dict of the values worth comparing between snapshots"""
+        counters = {
+            "memory_used_mb": self.memory.get("used_mb"),
+            "memory_available_mb": self.memory.get("available_mb"),
+            "file_descriptors": self.file_descriptors.get("allocated"),
+            "process_count": self.process_count,
+        }
+        for mount, usage in self.mounts.items():
+            counters[f"mount_{mount}_percent_used"] = usage["percent_used"]
+        for name, stats in self.interfaces.items():
+            counters[f"{name}_rx_bytes"] = stats["rx_bytes"]
+            counters[f"{name}_tx_bytes"] = stats["tx_bytes"]
+
+        return {key: value for key, value in counters.items() if value is not None}
+
+    def deltas(self, later):
+        """Change of the counters from this snapshot to a later one"""
+        before = self.counters()
+        return {
+            key: value - before[key]
+            for key, value in later.counters().items()
+            if key in before
+        }
+
+
+FACT_COMMANDS = {
+    "cpu_count": "grep -c ^processor /proc/cpuinfo",
+    "uptime": "cat /proc/uptime",
+    "load": "cat /proc/loadavg",
+    "memory": "free -m",
+    "mounts": "df -h",
+    "thermal": "for z in /sys/class/thermal/thermal_zone*/temp; "
+    'do [ -e "$z" ] && echo "$z $(cat $z)"; done',
+    "interfaces": "cat /proc/net/dev",
+    "file_descriptors": "cat /proc/sys/fs/file-nr",
+    "entropy": "cat /proc/sys/kernel/random/entropy_avail",
+    "process_count": "ps | wc -l",
+    "package_manager": "if command -v apk >/dev/null; then echo apk; "
+    "elif command -v opkg >/dev/null; then echo opkg; fi",
+}
+
+
+def parse_facts(board, outputs):
+    """Build DeviceFacts from the stdout of the FACT_COMMANDS"""
+    facts = DeviceFacts(board=board)
+
+    if outputs.get("cpu_count"):
+        facts.cpu_count = int(outputs["cpu_count"][0])
+    if outputs.get("uptime"):
+        facts.uptime = float(outputs["uptime"][0].split()[0])
+    if outputs.get("load"):
+        facts.load = tuple(float(load) for load in outputs["load"][0].split()[:3])
+
+    if len(outputs.get("memory", [])) > 1:
+        mem_lines = outputs["memory"][1].split()
+        facts.memory = {
+            "total_mb": int(mem_lines[1]),
+            "used_mb": int(mem_lines[2]),
+            "free_mb": int(mem_lines[3]),
+            "available_mb": int(mem_lines[6])
+            if len(mem_lines) > 6
+            else int(mem_lines[3]),
+        }
+
+    for line in outputs.get("mounts", [])[1:]:
+        parts = line.split()
+        if len(parts) >= 6:
+            facts.mounts[parts[5]] = {
+                "filesystem": parts[0],
+                "size": parts[1],
+                "used": parts[2],
+                "available": parts[3],
+                "percent_used": int(parts[4].rstrip("%")),
+            }
+
+    for line in outputs.get("thermal", []):
+        zone, _, temp = line.partition(" ")
+        if temp.strip().lstrip("-").isdigit():
+            facts.thermal[zone.split("/")[-2]] = int(temp) / 1000
+
+    for line in outputs.get("interfaces", [])[2:]:
+        name, _, stats = line.partition(":")
+        stats = stats.split()
+        if len(stats) >= 10:
+            facts.interfaces[name.strip()] = {
+                "rx_bytes": int(stats[0]),
+                "rx_packets": int(stats[1]),
+                "tx_bytes": int(stats[8]),
+                "tx_packets": int(stats[9]),
+            }
+
+    if outputs.get("file_descriptors"):
+        fd_info = outputs["file_descriptors"][0].split()
+        facts.file_descriptors = {
+            "allocated": int(fd_info[0]),
+            "maximum": int(fd_info[2]),
+        }
+
+    if outputs.get("entropy"):
+        facts.entropy = int(outputs["entropy"][0])
+    if outputs.get("process_count"):
+        facts.process_count = int(outputs["process_count"][0])
+    if outputs.get("package_manager"):
+        facts.package_manager = outputs["package_manager"][0]
+
+    return facts
+
+
+def collect_facts(command, ubus):
+    """Take a DeviceFacts snapshot, running all commands in one exchange"""
+    results = run_batch(command, list(FACT_COMMANDS.values()))
+    outputs = {
+        name: result.stdout
+        for name, result in zip(FACT_COMMANDS, results)
+        if result.exitcode == 0
+    }
+    return parse_facts(ubus.call("system", "board"), outputs)
+
 
 @pytest.fixture(scope="session", autouse=True)
 def setup_env(env, pytestconfig):
@@ -49,17 +1043,784 @@ def setup_env(env, pytestconfig):
     )
 
 
+@pytest.fixture(scope="session")
+def record_session_property():
+    """Record a property of the whole session in the junit report
+
+    record_testsuite_property does nothing on pytest-xdist workers, so the
+    property is added to the report of the running test as session.<name>
+    instead. contrib/history.py reads those as properties of the run.
+    """
+
+    def record(name, value):
+        session_properties.append((f"session.{name}", value))
+
+    return record
+
+
+@pytest.fixture(scope="session", autouse=True)
+def record_run(record_session_property):
+    """Identify the run in the junit report, see contrib/history.py"""
+    record_session_property("device", device)
+    if getenv("VERSION_NAME"):
+        record_session_property("version_name", getenv("VERSION_NAME"))
+
+
+@pytest.fixture(autouse=True)
+def record_results_bag(results_bag, record_property):
+    """Copy the results_bag of every test into the junit report"""
+    yield
+    for key, value in results_bag.items():
+        record_property(key, json.dumps(value))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def boot_timeouts(target, pytestconfig, record_session_property):
+    """Timeouts of the boot phases, learned from the boot history of the device
+
+    The timeouts configured for the drivers are the upper limit, a device
+    hanging at boot fails once it took longer than it ever did.
+    """
+    shell = target.get_driver("ShellDriver", activate=False)
+    ssh = target.get_driver("SSHDriver", activate=False)
+    timeouts = {
+        "login": shell.login_timeout,
+        "ssh": ssh.connection_timeout,
+    }
+
+    history = pytestconfig.getoption("timing_history")
+    if history and os.path.exists(history):
+        for phase, timeout in learn_timeouts(history, device).items():
+            timeouts[phase] = min(timeouts[phase], timeout)
+
+    shell.login_timeout = int(timeouts["login"])
+    ssh.connection_timeout = float(timeouts["ssh"])
+    for phase, timeout in timeouts.items():
+        record_session_property(f"timeout_{phase}", timeout)
+
+    return timeouts
+
+
+@pytest.fixture(scope="session", autouse=True)
+def isolate_worker(request, tmp_path_factory):
+    """Give each pytest-xdist worker its own QEMU disk overlay and snapshot"""
+    worker = getenv("PYTEST_XDIST_WORKER")
+    if worker is None:
+        return
+
+    strategy = request.getfixturevalue("strategy")
+    if not hasattr(strategy, "workdir"):
+        return
+
+    strategy.workdir = str(tmp_path_factory.mktemp("qemu"))
+    if strategy.snapshot_dir:
+        strategy.snapshot_dir = os.path.join(strategy.snapshot_dir, worker)
+
+
+class SSHConnection:
+    """SSH connection to the device shared by all tests of a session
+
+    The SSHDriver multiplexes all commands over a single ControlMaster
+    connection. Tests restarting the network or dropbear may kill it, in that
+    case the connection is established again and the command is retried.
+    The commands and handshakes are counted for the junit report.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.ssh = target.get_driver("SSHDriver", activate=False)
+        self.connected = False
+        self.handshakes = 0
+        self.handshake_time = 0.0
+        self.commands = 0
+
+    def connect(self):
+        if self.connected:
+            return
+
+        start = time.monotonic()
+        self.target.activate(self.ssh)
+        self.handshake_time += time.monotonic() - start
+        self.handshakes += 1
+        self.connected = True
+
+    def reconnect(self):
+        logger.info("SSH connection to the device lost, reconnecting")
+        self.connected = False
+        self.target.deactivate(self.ssh)
+        self.connect()
+
+    def call(self, method, *args, **kwargs):
+        self.connect()
+        self.commands += 1
+        try:
+            return getattr(self.ssh, method)(*args, **kwargs)
+        except ExecutionError as e:
+            # raised before anything was sent, safe to retry
+            if "Keepalive" not in e.msg:
+                raise
+            self.reconnect()
+            return getattr(self.ssh, method)(*args, **kwargs)
+
+    def run(self, cmd, **kwargs):
+        return self.call("run", cmd, **kwargs)
+
+    def run_check(self, cmd, *, timeout=30, **kwargs):
+        stdout, stderr, exitcode = self.run(cmd, timeout=timeout, **kwargs)
+        if exitcode != 0:
+            raise ExecutionError(cmd, stdout, stderr)
+        return stdout
+
+    def get(self, filename, destination="."):
+        return self.call("get", filename, destination)
+
+    def put(self, filename, remotepath=""):
+        return self.call("put", filename, remotepath)
+
+    def __getattr__(self, name):
+        return getattr(self.ssh, name)
+
+    def popen(self, cmd):
+        """Start cmd over the multiplexed connection without waiting for it"""
+        self.connect()
+        # the same command line as SSHDriver.run, with the configured ssh
+        # tool and username
+        networkservice = self.ssh.networkservice
+        return subprocess.Popen(
+            [
+                self.ssh._ssh,
+                "-x",
+                *self.ssh.ssh_prefix,
+                "-p",
+                str(networkservice.port),
+                "-l",
+                self.ssh._get_username(),
+                networkservice.address,
+                cmd,
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+
+SAMPLE_SCRIPT = """\
+while :; do
+    read -r u _ < /proc/uptime; echo "@sample $u"
+    read -r l < /proc/stat; echo "$l"
+    read -r l < /proc/loadavg; echo "load $l"
+    while read -r k v _; do
+        case $k in MemTotal:|MemAvailable:) echo "$k $v";; esac
+    done < /proc/meminfo
+    echo "fds $(cat /proc/sys/fs/file-nr)"
+    cat /proc/net/dev
+    echo @end
+    sleep {interval}
+done
+"""
+
+
+class ResourceSampler:
+    """Sample CPU, memory, load, fds and interface counters of the DUT
+
+    A single shell loop runs on the DUT for the whole session and prints a
+    sample every interval over the multiplexed SSH connection. Samples are
+    tagged with the test running at the time and kept in a bounded buffer.
+    The loop is restarted if the connection dropped.
+    """
+
+    def __init__(self, connection, interval, limit):
+        self.connection = connection
+        self.interval = interval
+        self.samples = deque(maxlen=limit)
+        self.test = None
+        self.process = None
+        self.thread = None
+        self.last_cpu = None
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        if self.running():
+            return
+
+        try:
+            self.process = self.connection.popen(
+                SAMPLE_SCRIPT.format(interval=self.interval)
+            )
+        except Exception:
+            logger.warning("Could not start the resource sampler", exc_info=True)
+            return
+
+        self.last_cpu = None
+        self.thread = threading.Thread(
+            target=self.read, args=(self.process,), daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def read(self, process):
+        lines = []
+        for line in process.stdout:
+            line = line.strip()
+            if line.startswith("@sample"):
+                lines = [line]
+            elif line == "@end" and lines:
+                try:
+                    self.samples.append(self.parse(lines))
+                except (ValueError, IndexError):
+                    logger.debug("Dropping malformed resource sample %s", lines)
+                lines = []
+            elif lines:
+                lines.append(line)
+
+    def parse(self, lines):
+        sample = {
+            "time": round(time.time(), 3),
+            "uptime": float(lines[0].split()[1]),
+            "test": self.test,
+            "interfaces": {},
+        }
+
+        for line in lines[1:]:
+            key, _, values = line.partition(" ")
+            values = values.split()
+            if key == "cpu":
+                cpu = [int(value) for value in values[:8]]
+                # idle and iowait are the 4th and 5th field
+                busy, total = sum(cpu) - cpu[3] - cpu[4], sum(cpu)
+                if self.last_cpu and total > self.last_cpu[1]:
+                    sample["cpu_percent"] = round(
+                        100 * (busy - self.last_cpu[0]) / (total - self.last_cpu[1]),
+                        1,
+                    )
+                self.last_cpu = (busy, total)
+            elif key == "load":
+                sample["load"] = [float(value) for value in values[:3]]
+            elif key == "MemTotal:":
+                sample["mem_total_kb"] = int(values[0])
+            elif key == "MemAvailable:":
+                sample["mem_available_kb"] = int(values[0])
+            elif key == "fds":
+                sample["fds"] = int(values[0])
+            elif ":" in line:
+                name, _, counters = line.partition(":")
+                counters = counters.split()
+                if len(counters) >= 9:
+                    sample["interfaces"][name.strip()] = {
+                        "rx_bytes": int(counters[0]),
+                        "tx_bytes": int(counters[8]),
+                    }
+
+        return sample
+
+
+def host_address(strategy, pytestconfig, interface="lan"):
+    """Address under which the DUT reaches servers running on this host
+
+    QEMU user networking makes the host reachable as the second address of
+    every network, real devices need --host-address. Returns None if the
+    host can not be reached.
+    """
+    qemu = getattr(strategy, "qemu", None)
+    if qemu is not None:
+        if "user" not in qemu.nic.split(","):
+            return None
+        return {"lan": "192.168.1.2", "wan": "10.0.2.2"}[interface]
+    return pytestconfig.getoption("host_address")
+
+
+# Indexes and their signatures change with every build of the feed, packages
+# are named by their version and never change
+FEED_INDEX_RE = re.compile(
+    r"(?:^|/)(?:Packages(?:\.gz|\.sig|\.manifest)?|packages\.adb|index\.json)$"
+)
+FEED_INDEX_MAX_AGE = 24 * 60 * 60
+
+
+class PackageFeed:
+    """Local stand-in for the package feeds of the DUT
+
+    Serves http://<address>/<host>/<path> from a cache of https://<host>/<path>.
+    Files missing in the cache are downloaded once, so the cache only holds
+    the indexes and packages the tests asked for. Indexes older than
+    FEED_INDEX_MAX_AGE are downloaded again if possible, which keeps them and
+    their signatures consistent. Without internet access only cached files
+    are served.
+    """
+
+    def __init__(self, cache, bind="127.0.0.1"):
+        self.cache = Path(cache)
+        self.hosts = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        feed = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = feed.get(self.path)
+                if path is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(path.stat().st_size))
+                self.end_headers()
+                with open(path, "rb") as f:
+                    while chunk := f.read(64 * 1024):
+                        self.wfile.write(chunk)
+
+            def log_message(self, format, *args):
+                logger.debug("package feed: " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((bind, 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get(self, url_path):
+        """Return the cached file of url_path, downloading it if required"""
+        host, _, path = url_path.lstrip("/").partition("/")
+        parts = path.split("/")
+        if host not in self.hosts or not path or ".." in parts or "" in parts:
+            return None
+
+        local = self.cache / host / path
+        fresh = local.exists() and (
+            not FEED_INDEX_RE.search(path)
+            or time.time() - local.stat().st_mtime < FEED_INDEX_MAX_AGE
+        )
+        if fresh:
+            self.hits += 1
+            return local
+
+        with self.lock:
+            self.misses += 1
+            try:
+                with urllib.request.urlopen(
+                    f"https://{host}/{path}", timeout=30
+                ) as response:
+                    local.parent.mkdir(parents=True, exist_ok=True)
+                    partial = local.with_name(local.name + ".part")
+                    with open(partial, "wb") as f:
+                        while chunk := response.read(64 * 1024):
+                            f.write(chunk)
+                    partial.replace(local)
+            except (urllib.error.URLError, OSError) as e:
+                logger.info("package feed: %s/%s not downloaded: %s", host, path, e)
+
+        return local if local.exists() else None
+
+    def url(self, address):
+        return f"http://{address}:{self.port}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Certificates of the TLS stand-in, see TLSStandIn. The DUT validates them
+# against a CA uploaded for the test, untrusted_root is signed by another CA.
+TLS_SCENARIOS = {
+    "valid": {"ca": "trusted", "days": 2},
+    "expired": {"ca": "trusted", "days": -1},
+    "wrong_host": {"ca": "trusted", "days": 2, "host": "wrong.host.invalid"},
+    "untrusted_root": {"ca": "untrusted", "days": 2},
+    "weak_cipher": {"ca": "trusted", "days": 2, "weak": True},
+}
+
+
+def openssl(args, cwd):
+    subprocess.run(
+        ["openssl", *shlex.split(args)],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+class TLSStandIn:
+    """Local HTTPS servers replacing badssl.com for the download tests
+
+    Every scenario of TLS_SCENARIOS gets its own server and certificate for
+    address, plus a plain HTTP server named "http". The certificates are
+    generated with the openssl command line tool into directory. Servers
+    answer /index.html and /bytes/<size> with size bytes for throughput
+    measurements. Scenarios the TLS library of this host refuses to serve
+    (TLS 1.0 for weak_cipher) are left out of servers.
+    """
+
+    INDEX = b"<html><body>openwrt-tests</body></html>\n"
+
+    def __init__(self, directory, address, bind="127.0.0.1"):
+        self.directory = Path(directory)
+        self.address = address
+        self.servers = {}
+
+        for ca in ("trusted", "untrusted"):
+            openssl(
+                "req -x509 -newkey ec -pkeyopt ec_paramgen_curve:P-256 -nodes "
+                f"-days 2 -keyout {ca}-ca.key -out {ca}-ca.pem "
+                f"-subj '/CN=openwrt-tests {ca} CA'",
+                self.directory,
+            )
+        self.ca = self.directory / "trusted-ca.pem"
+
+        self.servers["http"] = self.serve(bind)
+        for name, scenario in TLS_SCENARIOS.items():
+            try:
+                context = self.context(name, **scenario)
+            except ssl.SSLError as e:
+                logger.info("TLS stand-in: no %s scenario: %s", name, e)
+                continue
+            self.servers[name] = self.serve(bind, context)
+
+    def certificate(self, name, ca, days, host):
+        # mbedTLS and wolfSSL match IP addresses against DNS names as well
+        alt_names = f"DNS:{host}"
+        if re.fullmatch(r"[0-9.]+|[0-9a-fA-F:]+", host):
+            alt_names += f",IP:{host}"
+        (self.directory / f"{name}.ext").write_text(f"subjectAltName={alt_names}\n")
+        openssl(
+            "req -new -newkey ec -pkeyopt ec_paramgen_curve:P-256 -nodes "
+            f"-keyout {name}.key -out {name}.csr -subj /CN={host}",
+            self.directory,
+        )
+        openssl(
+            f"x509 -req -in {name}.csr -CA {ca}-ca.pem -CAkey {ca}-ca.key "
+            f"-CAcreateserial -days {days} -extfile {name}.ext -out {name}.pem",
+            self.directory,
+        )
+        return self.directory / f"{name}.pem", self.directory / f"{name}.key"
+
+    def context(self, name, ca, days, host=None, weak=False):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        if weak:
+            # RSA key exchange with TLS 1.0, which the DUT must refuse
+            context.set_ciphers("AES128-SHA:@SECLEVEL=0")
+            context.minimum_version = ssl.TLSVersion.TLSv1
+            context.maximum_version = ssl.TLSVersion.TLSv1
+            openssl(
+                f"req -x509 -newkey rsa:2048 -nodes -days 2 -keyout {name}.key "
+                f"-out {name}.pem -subj /CN={self.address}",
+                self.directory,
+            )
+            context.load_cert_chain(
+                self.directory / f"{name}.pem", self.directory / f"{name}.key"
+            )
+            return context
+
+        context.load_cert_chain(*self.certificate(name, ca, days, host or self.address))
+        return context
+
+    def serve(self, bind, context=None):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/index.html":
+                    body, size = stand_in.INDEX, len(stand_in.INDEX)
+                elif match := re.fullmatch(r"/bytes/(\d+)", self.path):
+                    body, size = bytes(64 * 1024), int(match.group(1))
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                while size > 0:
+                    self.wfile.write(body[:size])
+                    size -= len(body)
+
+            def log_message(self, format, *args):
+                logger.debug("TLS stand-in: " + format, *args)
+
+        server = http.server.ThreadingHTTPServer((bind, 0), Handler)
+        if context is not None:
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def url(self, scenario, path="/index.html"):
+        scheme = "http" if scenario == "http" else "https"
+        port = self.servers[scenario].server_address[1]
+        return f"{scheme}://{self.address}:{port}{path}"
+
+    def close(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+def record_boot_timings(strategy, ssh_connection, record_session_property):
+    """Add the boot phase timings of the strategy to the junit report
+
+    SSH readiness is measured here as it is not part of any strategy. A
+    broken SSH server is reported by the SSH tests, not here.
+    """
+    timings = getattr(strategy, "boot_timings", None)
+    if not timings or "ssh" in timings:
+        return
+
+    try:
+        ssh_connection.connect()
+        strategy.record_timing("ssh")
+    except Exception:
+        # labgrid raises a plain Exception once the connection timed out
+        logger.warning(
+            "SSH not ready after boot, not recording its timing", exc_info=True
+        )
+        timings["ssh"] = None
+
+    for phase, seconds in timings.items():
+        if seconds is not None:
+            record_session_property(f"boot_{phase}", seconds)
+
+    for key, value in getattr(strategy, "flash_stats", {}).items():
+        record_session_property(f"flash_{key}", value)
+
+
+@pytest.fixture(scope="session")
+def ssh_connection(target, record_session_property):
+    connection = SSHConnection(target)
+    yield connection
+
+    logger.info(
+        "SSH: %d commands over %d handshakes",
+        connection.commands,
+        connection.handshakes,
+    )
+    record_session_property("ssh_commands", connection.commands)
+    record_session_property("ssh_handshakes", connection.handshakes)
+    record_session_property("ssh_handshake_time", round(connection.handshake_time, 3))
+
+
+@pytest.fixture(scope="session")
+def ubus_client(ssh_connection):
+    return UbusClient(ssh_connection)
+
+
+@pytest.fixture
+def ubus(ssh_command, ubus_client):
+    return ubus_client
+
+
+@pytest.fixture
+def shell_ubus(shell_command):
+    """ubus over the serial console, for tests which must not depend on SSH"""
+    return UbusClient(shell_command)
+
+
+@pytest.fixture(scope="session")
+def facts_snapshots(ssh_connection, ubus_client, record_session_property):
+    """The DeviceFacts taken by device_facts, compared at the end of the session
+
+    A second snapshot is taken at the end of the session, the changes of
+    memory, file descriptors, processes, mounts and interface counters are
+    recorded as facts_delta_* properties.
+    """
+    snapshots = []
+    yield snapshots
+
+    if not snapshots or not ssh_connection.connected:
+        return
+    try:
+        later = collect_facts(ssh_connection, ubus_client)
+    except (ExecutionError, UbusError, ValueError):
+        logger.warning("Could not collect device facts at session end", exc_info=True)
+        return
+
+    for key, delta in snapshots[0].deltas(later).items():
+        record_session_property(f"facts_delta_{key}", delta)
+
+
 @pytest.fixture
-def shell_command(strategy):
+def device_facts(ssh_command, ubus_client, facts_snapshots):
+    """Facts about the DUT, collected once per session when the shell is ready"""
+    if not facts_snapshots:
+        facts_snapshots.append(collect_facts(ssh_command, ubus_client))
+    return facts_snapshots[0]
+
+
+@pytest.fixture(scope="session")
+def resource_sampler(request, pytestconfig, record_session_property):
+    """Background sampler of DUT resources, None unless --sample-interval is set
+
+    The samples are written to resource-samples.json in the labgrid log
+    directory (or the current directory) at the end of the session.
+    """
+    interval = pytestconfig.getoption("sample_interval")
+    if not interval:
+        yield None
+        return
+
+    sampler = ResourceSampler(
+        request.getfixturevalue("ssh_connection"),
+        interval,
+        pytestconfig.getoption("sample_limit"),
+    )
+    yield sampler
+
+    sampler.stop()
+    path = os.path.join(pytestconfig.option.lg_log or ".", "resource-samples.json")
+    with open(path, "w") as f:
+        json.dump(list(sampler.samples), f)
+
+    logger.info("Wrote %d resource samples to %s", len(sampler.samples), path)
+    record_session_property("resource_samples", os.path.abspath(path))
+
+
+@pytest.fixture(autouse=True)
+def tag_resource_samples(request, resource_sampler):
+    """Tag samples with the running test, (re)start sampling once the shell is up"""
+    if resource_sampler is None:
+        yield
+        return
+
+    strategy = request.getfixturevalue("strategy")
+    resource_sampler.test = request.node.nodeid
+    if strategy.status.name == "shell":
+        resource_sampler.start()
+    yield
+
+    if strategy.status.name == "shell":
+        resource_sampler.start()
+    resource_sampler.test = None
+
+
+@pytest.fixture(scope="session")
+def kernel_log():
+    return KernelLog()
+
+
+@pytest.fixture(autouse=True)
+def check_kernel_log(request, kernel_log):
+    """Warn about kernel errors logged during the test
+
+    The warning is attributed to the test in the pytest summary, a failure
+    in the teardown would be reported as an error of the test instead.
+    Errors logged while booting are left to test_kernel_errors. shell_command
+    moves the cursor past them before the first test, a reboot moves it
+    past the log of the new boot.
+    """
+    yield
+
+    strategy = request.getfixturevalue("strategy")
+    if getattr(strategy, "status", None) is None or strategy.status.name != "shell":
+        return
+
+    # without a working SSH server every check would wait for a timeout
+    ssh_connection = request.getfixturevalue("ssh_connection")
+    if not ssh_connection.connected:
+        return
+
+    try:
+        errors = kernel_log.check(ssh_connection)
+    except Exception:
+        logger.warning("Could not read the kernel log", exc_info=True)
+        return
+
+    if errors:
+        warnings.warn(KernelErrorWarning(f"Kernel logged errors: {errors[:5]}"))
+
+
+@pytest.fixture(scope="session")
+def package_feed_server(strategy, pytestconfig):
+    bind = "127.0.0.1" if getattr(strategy, "qemu", None) else "0.0.0.0"
+    feed = PackageFeed(pytestconfig.getoption("feed_cache"), bind)
+    yield feed
+    feed.close()
+
+
+@pytest.fixture
+def package_feed(ssh_command, strategy, pytestconfig, request, results_bag):
+    """Point the package feeds of the DUT to a local stand-in for the test
+
+    The feeds keep their signed indexes, so package signatures are verified
+    as usual. If the DUT can not reach this host, the online feeds are used
+    with LG_FEATURE_ONLINE and the test is skipped otherwise.
+    """
+    address = host_address(strategy, pytestconfig)
+    if address is None:
+        if getenv("LG_FEATURE_ONLINE") is None:
+            pytest.skip("DUT can not reach this host, pass --host-address")
+        yield None
+        return
+
+    feed = request.getfixturevalue("package_feed_server")
+    configs = "/etc/apk/repositories.d/distfeeds.list /etc/opkg/distfeeds.conf"
+    # the original configuration is kept in .orig until the test is done
+    hosts = ssh_command.run(
+        f"for f in {configs}; do [ -f $f ] || continue; "
+        "[ -f $f.orig ] || cp $f $f.orig; "
+        "sed -n 's#.*https*://\\([^/]*\\)/.*#\\1#p' $f.orig; done"
+    )[0]
+    feed.hosts.update(hosts)
+    ssh_command.run_check(
+        f"for f in {configs}; do [ -f $f.orig ] || continue; "
+        f"sed 's#https*://\\([^/]*\\)/#{feed.url(address)}/\\1/#' $f.orig > $f; done"
+    )
+    hits, misses = feed.hits, feed.misses
+
+    yield feed
+
+    ssh_command.run(f"for f in {configs}; do [ -f $f.orig ] && mv $f.orig $f; done")
+    results_bag["feed_cache_hits"] = feed.hits - hits
+    results_bag["feed_cache_misses"] = feed.misses - misses
+
+
+@pytest.fixture(scope="session")
+def tls_server(strategy, pytestconfig, tmp_path_factory):
+    """TLS stand-in the DUT reaches through its WAN port, see TLSStandIn"""
+    address = host_address(strategy, pytestconfig, "wan")
+    if address is None:
+        pytest.skip("DUT can not reach this host, pass --host-address")
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is required to generate the certificates")
+
+    bind = "127.0.0.1" if getattr(strategy, "qemu", None) else "0.0.0.0"
+    server = TLSStandIn(tmp_path_factory.mktemp("tls"), address, bind)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def tls_ca(ssh_command, tls_server):
+    """Path of the CA of the TLS stand-in on the DUT, for wget --ca-certificate"""
+    path = "/tmp/openwrt-tests-ca.pem"
+    ssh_command.run_check(f"echo {shlex.quote(tls_server.ca.read_text())} > {path}")
+    yield path
+    ssh_command.run(f"rm -f {path}")
+
+
+@pytest.fixture
+def shell_command(strategy, ssh_connection, record_session_property, kernel_log):
     try:
         strategy.transition("shell")
-        return strategy.shell
     except Exception:
         logger.exception("Failed to transition to state shell")
         pytest.exit("Failed to transition to state shell", returncode=3)
 
+    record_boot_timings(strategy, ssh_connection, record_session_property)
+    if kernel_log.boot_id is None and ssh_connection.connected:
+        try:
+            kernel_log.read(ssh_connection)
+        except Exception:
+            logger.warning("Could not read the kernel log", exc_info=True)
+    return strategy.shell
+
 
 @pytest.fixture
-def ssh_command(shell_command, target):
-    ssh = target.get_driver("SSHDriver")
-    return ssh
+def ssh_command(shell_command, ssh_connection):
+    ssh_connection.connect()
+    return ssh_connection
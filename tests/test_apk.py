@@ -1,4 +1,5 @@
 import os
+import time
 
 import pytest
 
@@ -10,12 +11,16 @@ class TestApk:
     def test_apk_procd_installed(self, ssh_command):
         assert "procd" in "\n".join(ssh_command.run_check("apk list"))
 
-    @pytest.mark.skipif(
-        os.getenv("LG_FEATURE_ONLINE") is None, reason="LG_FEATURE_ONLINE not defined"
-    )
-    def test_apk_add_ucert(self, ssh_command):
+    def test_apk_add_ucert(self, ssh_command, package_feed, results_bag):
         try:
-            ssh_command.run_check("apk add ucert")
+            start = time.monotonic()
+            ssh_command.run_check("apk update", timeout=120)
+            results_bag["update_time"] = round(time.monotonic() - start, 3)
+
+            start = time.monotonic()
+            ssh_command.run_check("apk add ucert", timeout=120)
+            results_bag["install_time"] = round(time.monotonic() - start, 3)
+
             assert "ucert" in "\n".join(ssh_command.run_check("apk list | grep ucert"))
         finally:
             ssh_command.run("apk del ucert")
@@ -1,10 +1,8 @@
 import os
-import re
 import tarfile
-import time
 
 import pytest
-from conftest import ubus_call
+from conftest import kernel_errors, wait_for_ssh
 
 
 def test_shell(shell_command):
@@ -23,14 +21,20 @@ def test_firmware_version(shell_command, record_property):
         )
 
 
-def test_dropbear_startup(shell_command):
-    for i in range(120):
-        if shell_command.run("ls /etc/dropbear/dropbear_rsa_host_key")[2] == 0:
-            if shell_command.run("netstat -tlpn | grep 0.0.0.0:22")[2] == 0:
-                return
-        time.sleep(1)
+def test_dropbear_startup(
+    shell_command, ssh_connection, strategy, boot_timeouts, results_bag
+):
+    timeout = boot_timeouts["ssh"]
+    timings = getattr(strategy, "boot_timings", {})
+    if timings.get("ssh") is not None and "shell" in timings:
+        # SSH was waited for right after the boot, see record_boot_timings
+        waited = round(timings["ssh"] - timings["shell"], 3)
+    else:
+        waited = wait_for_ssh(ssh_connection, timeout)
+    assert waited is not None, f"Dropbear did not start up within {timeout} seconds"
 
-    assert False, "Dropbear did not start up within 120 seconds"
+    results_bag["dropbear_wait"] = waited
+    shell_command.run_check("ls /etc/dropbear/dropbear_rsa_host_key")
 
 
 def test_ssh(ssh_command):
@@ -47,8 +51,8 @@ def test_uname(ssh_command):
     assert "GNU/Linux" in output
 
 
-def test_ubus_system_board(ssh_command, results_bag):
-    output = ubus_call(ssh_command, "system", "board", {})
+def test_ubus_system_board(ubus, results_bag):
+    output = ubus.call("system", "board")
     assert output["release"]["distribution"] == "OpenWrt"
 
     results_bag["board_name"] = output["board_name"]
@@ -59,63 +63,39 @@ def test_ubus_system_board(ssh_command, results_bag):
     results_bag["version"] = output["release"]["version"]
 
 
-def test_free_memory(ssh_command, results_bag):
-    used_memory = int(ssh_command.run_check("free -m")[1].split()[2])
+def test_free_memory(device_facts, results_bag):
+    used_memory = device_facts.memory["used_mb"]
 
     assert used_memory > 10000, "Used memory is more than 100MB"
     results_bag["used_memory"] = used_memory
 
 
 @pytest.mark.lg_feature("rootfs")
-def test_sysupgrade_backup(ssh_command):
+def test_sysupgrade_backup(ssh_command, tmp_path):
     try:
         ssh_command.run_check("sysupgrade -b /tmp/backup.tar.gz")
-        ssh_command.get("/tmp/backup.tar.gz")
+        ssh_command.get("/tmp/backup.tar.gz", str(tmp_path))
 
-        backup = tarfile.open("backup.tar.gz", "r")
+        backup = tarfile.open(tmp_path / "backup.tar.gz", "r")
         assert "etc/config/dropbear" in backup.getnames()
     finally:
         ssh_command.run("rm -rf /tmp/backup.tar.gz")
 
 
 @pytest.mark.lg_feature("rootfs")
-def test_sysupgrade_backup_u(ssh_command):
+def test_sysupgrade_backup_u(ssh_command, tmp_path):
     try:
         ssh_command.run_check("sysupgrade -u -b /tmp/backup.tar.gz")
-        ssh_command.get("/tmp/backup.tar.gz")
+        ssh_command.get("/tmp/backup.tar.gz", str(tmp_path))
 
-        backup = tarfile.open("backup.tar.gz", "r")
+        backup = tarfile.open(tmp_path / "backup.tar.gz", "r")
         assert "etc/config/dropbear" not in backup.getnames()
     finally:
         ssh_command.run("rm -rf /tmp/backup.tar.gz")
 
 
 def test_kernel_errors(ssh_command):
-    dmesg_output = "\n".join(ssh_command.run_check("dmesg"))
-
-    error_patterns = [
-        r" Oops:",  # don't trigger on "ramoops"
-        r"(PC is at |pc : )([^+\[ ]+).*",
-        r"BUG:",
-        r"corruption",
-        r"do_page_fault\(\): sending",
-        r"EIP: \[<.*>\] ([^+ ]+).*",
-        r"epc\s+:\s+\S+\s+([^+ ]+).*",
-        r"error.*in",
-        r"hung task",
-        r"Kernel panic",
-        r"Out of memory",
-        r"segfault",
-        r"stack overflow",
-        r"traps:.*general protection",
-        r"Unable to handle kernel",
-    ]
-
-    errors_found = []
-    for pattern in error_patterns:
-        matches = re.findall(f".*{pattern}.*", dmesg_output)
-        if matches:
-            errors_found.extend(matches)
+    errors_found = kernel_errors(ssh_command.run_check("dmesg"))
 
     assert not errors_found, (
         f"Critical errors found in kernel log: {errors_found[:5]}"
@@ -0,0 +1,19 @@
+from conftest import boot_timeline, read_boot_logs, read_console
+
+
+def test_boot_timeline(ssh_command, strategy, target, pytestconfig, results_bag):
+    lines, booted = read_boot_logs(ssh_command)
+    assert booted is not None, "Could not read the clock of the DUT"
+
+    # the console log still has the early kernel messages if the dmesg ring
+    # buffer overflowed, only the last boot in it is of interest
+    if pytestconfig.option.lg_log:
+        console = read_console(pytestconfig.option.lg_log, f"console_{target.name}")
+        lines += console[console.rfind("Linux version") :].splitlines()
+
+    timeline = boot_timeline(lines, booted)
+    results_bag["boot_timeline"] = timeline
+    results_bag["boot_timings"] = getattr(strategy, "boot_timings", {})
+
+    assert "kernel_start" in timeline, "Kernel start not found in the logs"
+    assert "procd_init" in timeline, "procd init not found in the logs"
@@ -0,0 +1,123 @@
+"""Throughput benchmarks between the lab host and the DUT using iperf3."""
+
+import json
+import shutil
+import subprocess
+
+import pytest
+from conftest import device
+from labgrid.util import get_free_port
+
+pytestmark = pytest.mark.lg_feature("iperf3")
+
+IPERF3_PORT = 5201
+DURATION = 10
+UDP_BITRATE = "1G"
+
+# Minimal throughput in Mbit/s per device and interface. Devices without an
+# entry only record their results.
+THRESHOLDS = {
+    "qemu_x86-64": {"lan": 50, "wan": 50},
+    "qemu_armsr-armv8": {"lan": 10, "wan": 10},
+    "qemu_malta-be": {"lan": 2, "wan": 2},
+}
+
+
+@pytest.fixture(
+    params=["lan", pytest.param("wan", marks=pytest.mark.lg_feature("wan_port"))]
+)
+def iperf3_server(request, ssh_command, ubus, strategy):
+    """Run an iperf3 server on the DUT, return interface, host and port to reach it"""
+    interface = request.param
+
+    if shutil.which("iperf3") is None:
+        pytest.skip("iperf3 is not installed on the host")
+    if ssh_command.run("command -v iperf3")[2] != 0:
+        pytest.skip("iperf3 is not installed on the DUT")
+
+    status = ubus.call(f"network.interface.{interface}", "status")
+    assert status["ipv4-address"], f"{interface} has no IPv4 address"
+    address = status["ipv4-address"][0]["address"]
+
+    # QEMU user networking is only reachable via port forwards, real devices
+    # have to be reachable from the lab host directly
+    qemu = getattr(strategy, "qemu", None)
+    forwards = []
+    if qemu is not None:
+        host, port = "127.0.0.1", get_free_port()
+        for proto in ("tcp", "udp"):
+            qemu.add_port_forward(proto, host, port, address, IPERF3_PORT, interface)
+            forwards.append((proto, host, port, interface))
+    else:
+        host, port = address, IPERF3_PORT
+
+    if interface == "wan":
+        ssh_command.run_check(
+            "nft insert rule inet fw4 input_wan meta l4proto '{ tcp, udp }' "
+            f"th dport {IPERF3_PORT} accept comment iperf3"
+        )
+
+    ssh_command.run_check(
+        f"iperf3 -s -D -p {IPERF3_PORT} -I /tmp/iperf3.pid; "
+        "for i in 1 2 3 4 5 6 7 8 9 10; do "
+        f"netstat -ltn | grep -q ':{IPERF3_PORT} ' && break; sleep 0.2; done"
+    )
+
+    yield interface, host, port
+
+    ssh_command.run("kill $(cat /tmp/iperf3.pid); rm -f /tmp/iperf3.pid")
+    if interface == "wan":
+        ssh_command.run(
+            "nft -a list chain inet fw4 input_wan "
+            "| sed -n 's/.*comment \"iperf3\".*handle \\([0-9]*\\)/\\1/p' "
+            "| xargs -rn1 nft delete rule inet fw4 input_wan handle"
+        )
+    for forward in forwards:
+        qemu.remove_port_forward(*forward)
+
+
+@pytest.mark.parametrize("streams", [1, 4])
+@pytest.mark.parametrize("reverse", [False, True], ids=["upload", "download"])
+@pytest.mark.parametrize("protocol", ["tcp", "udp"])
+def test_iperf3_throughput(iperf3_server, protocol, reverse, streams, results_bag):
+    interface, host, port = iperf3_server
+
+    cmd = ["iperf3", "-c", host, "-p", str(port), "-t", str(DURATION), "-J"]
+    cmd += ["-P", str(streams)]
+    if protocol == "udp":
+        cmd += ["-u", "-b", UDP_BITRATE]
+    if reverse:
+        cmd.append("-R")
+
+    output = subprocess.run(
+        cmd, capture_output=True, text=True, check=False, timeout=DURATION + 30
+    )
+    # iperf3 reports most errors in its JSON output, but not all of them
+    assert output.stdout.strip(), (
+        f"iperf3 exited with {output.returncode}: {output.stderr.strip()}"
+    )
+    report = json.loads(output.stdout)
+    error = report.get("error") or output.stderr.strip()
+    assert output.returncode == 0 and "error" not in report, f"iperf3 failed: {error}"
+
+    end = report["end"]
+    received = end.get("sum_received", end.get("sum"))
+    mbps = round(received["bits_per_second"] / 1e6, 2)
+
+    results_bag["interface"] = interface
+    results_bag["protocol"] = protocol
+    results_bag["direction"] = "download" if reverse else "upload"
+    results_bag["streams"] = streams
+    results_bag["throughput_mbps"] = mbps
+    if protocol == "tcp":
+        results_bag["retransmits"] = end["sum_sent"].get("retransmits")
+    else:
+        results_bag["jitter_ms"] = end["sum"]["jitter_ms"]
+        results_bag["lost_percent"] = end["sum"]["lost_percent"]
+
+    threshold = THRESHOLDS.get(device, {}).get(interface)
+    if threshold is not None:
+        assert mbps >= threshold, (
+            f"{protocol} throughput on {interface} is {mbps} Mbit/s, "
+            f"expected at least {threshold} Mbit/s"
+        )
@@ -1,16 +1,17 @@
 from ipaddress import IPv4Interface
 
-from conftest import ubus_call
+from conftest import wait_for_interface
 
 
-def test_lan_wait_for_network(shell_command):
-    for _ in range(60):
-        if ubus_call(shell_command, "network.interface.lan", "status").get(
-            "ipv4-address"
-        ):
-            return
+def test_lan_wait_for_network(shell_command, shell_ubus, results_bag):
+    waited = wait_for_interface(shell_command, "lan", timeout=60)
+    assert waited is not None, "LAN interface did not come up within 60 seconds"
 
-    assert False, "LAN interface did not come up within 60 seconds"
+    results_bag["lan_up_wait"] = waited
+
+    status = shell_ubus.call("network.interface.lan", "status")
+    assert status["up"], "LAN interface is not up"
+    results_bag["lan_address"] = status["ipv4-address"][0]["address"]
 
 
 def test_lan_interface_address(shell_command):
@@ -1,49 +1,80 @@
-import re
-import subprocess
-from collections import defaultdict
+import asyncio
+import time
 
+import pytest
+from conftest import listening_sockets, scan_ports, ssh_kexinit
+from labgrid.util import get_free_port
 
-def test_ssh_supported_algorithms(ssh_command):
+
+def test_ssh_supported_algorithms(ssh_command, results_bag):
     with ssh_command.forward_local_port(22) as localport:
-        output = subprocess.check_output(
-            f"nmap --script ssh2-enum-algos -sV -p {localport} localhost",
-            text=True,
-            shell=True,
-        )
-
-        pattern = re.compile(
-            r"""
-        ^\|\s{2,}(?P<category>\w+_algorithms):\s\(\d+\)     # Algorithm category
-        |^\|\s{7}(?P<algorithm>[^\n|]+)                     # Algorithm entries
-        """,
-            re.MULTILINE | re.VERBOSE,
-        )
-
-        algorithms = defaultdict(list)
-        current_category = None
-
-        for match in pattern.finditer(output):
-            if match.group("category"):
-                current_category = match.group("category")
-            elif match.group("algorithm") and current_category:
-                algorithms[current_category].append(match.group("algorithm").strip())
-
-        algorithms = dict(algorithms)
-
-        print(algorithms)
-        assert "curve25519-sha256" in algorithms["kex_algorithms"]
-        assert "curve25519-sha256@libssh.org" in algorithms["kex_algorithms"]
-        assert "diffie-hellman-group14-sha256" in algorithms["kex_algorithms"]
-        assert "kexguess2@matt.ucc.asn.au" in algorithms["kex_algorithms"]
-        assert "kex-strict-s-v00@openssh.com" in algorithms["kex_algorithms"]
-
-        assert "ssh-ed25519" in algorithms["server_host_key_algorithms"]
-        assert "rsa-sha2-256" in algorithms["server_host_key_algorithms"]
-
-        assert "chacha20-poly1305@openssh.com" in algorithms["encryption_algorithms"]
-        assert "aes128-ctr" in algorithms["encryption_algorithms"]
-        assert "aes256-ctr" in algorithms["encryption_algorithms"]
-
-        assert "hmac-sha2-256" in algorithms["mac_algorithms"]
-
-        print(algorithms)
+        algorithms = asyncio.run(ssh_kexinit("localhost", localport))
+
+    results_bag["ssh_banner"] = algorithms["banner"]
+    print(algorithms)
+    assert "curve25519-sha256" in algorithms["kex_algorithms"]
+    assert "curve25519-sha256@libssh.org" in algorithms["kex_algorithms"]
+    assert "diffie-hellman-group14-sha256" in algorithms["kex_algorithms"]
+    assert "kexguess2@matt.ucc.asn.au" in algorithms["kex_algorithms"]
+    assert "kex-strict-s-v00@openssh.com" in algorithms["kex_algorithms"]
+
+    assert "ssh-ed25519" in algorithms["server_host_key_algorithms"]
+    assert "rsa-sha2-256" in algorithms["server_host_key_algorithms"]
+
+    ciphers = algorithms["encryption_algorithms_client_to_server"]
+    assert "chacha20-poly1305@openssh.com" in ciphers
+    assert "aes128-ctr" in ciphers
+    assert "aes256-ctr" in ciphers
+
+    assert "hmac-sha2-256" in algorithms["mac_algorithms_client_to_server"]
+
+
+@pytest.mark.parametrize(
+    "interface", ["lan", pytest.param("wan", marks=pytest.mark.lg_feature("wan_port"))]
+)
+def test_exposed_services(ssh_command, ubus, strategy, interface, results_bag):
+    """Probe every listening service of the DUT through interface from the host"""
+    status = ubus.call(f"network.interface.{interface}", "status")
+    assert status["ipv4-address"], f"{interface} has no IPv4 address"
+    address = status["ipv4-address"][0]["address"]
+
+    services = sorted(
+        {
+            (proto, port)
+            for proto, bound, port in listening_sockets(ssh_command)
+            if bound in ("0.0.0.0", "::", address)
+        }
+    )
+
+    # QEMU user networking is only reachable via port forwards, real devices
+    # have to be reachable from the lab host directly
+    qemu = getattr(strategy, "qemu", None)
+    forwards = []
+    targets = []
+    try:
+        for proto, port in services:
+            if qemu is not None:
+                host, local_port = "127.0.0.1", get_free_port()
+                qemu.add_port_forward(proto, host, local_port, address, port, interface)
+                forwards.append((proto, host, local_port, interface))
+                targets.append((proto, host, local_port))
+            else:
+                targets.append((proto, address, port))
+
+        start = time.monotonic()
+        states = asyncio.run(scan_ports(targets))
+        results_bag["scan_time"] = round(time.monotonic() - start, 3)
+    finally:
+        for forward in forwards:
+            qemu.remove_port_forward(*forward)
+
+    ports = {f"{proto}/{port}": state for (proto, port), state in zip(services, states)}
+    results_bag["ports"] = ports
+    exposed = [port for port, state in ports.items() if state == "open"]
+    print(ports)
+
+    if interface == "lan":
+        assert "tcp/22" in exposed, "SSH is not reachable from LAN"
+    else:
+        tcp = [port for port in exposed if port.startswith("tcp/")]
+        assert not tcp, f"TCP services reachable from WAN: {tcp}"
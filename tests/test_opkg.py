@@ -1,3 +1,5 @@
+import time
+
 import pytest
 
 
@@ -6,11 +8,17 @@ def test_opkg_procd_installed(ssh_command):
     assert "procd" in "\n".join(ssh_command.run_check("opkg list-installed"))
 
 
-@pytest.mark.lg_feature(["online", "opkg"])
-def test_opkg_install_ucert(ssh_command):
+@pytest.mark.lg_feature("opkg")
+def test_opkg_install_ucert(ssh_command, package_feed, results_bag):
     try:
-        ssh_command.run_check("opkg update")
-        ssh_command.run_check("opkg install ucert")
+        start = time.monotonic()
+        ssh_command.run_check("opkg update", timeout=120)
+        results_bag["update_time"] = round(time.monotonic() - start, 3)
+
+        start = time.monotonic()
+        ssh_command.run_check("opkg install ucert", timeout=120)
+        results_bag["install_time"] = round(time.monotonic() - start, 3)
+
         assert "ucert" in "\n".join(ssh_command.run_check("opkg list-installed"))
     finally:
         ssh_command.run("opkg remove ucert")
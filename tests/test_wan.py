@@ -1,5 +1,5 @@
 import pytest
-from conftest import ubus_call
+from conftest import wait_for_interface
 
 
 def check_download(
@@ -11,9 +11,10 @@ def check_download(
     expect_content=None,
     remove=True,
     filename="index.html",
+    options="",
 ):
     try:
-        stdout, stderr, exitcode = command.run(f"wget {url} -O {filename}")
+        stdout, stderr, exitcode = command.run(f"wget {options} {url} -O {filename}")
         if expect_stdout:
             found = False
             for line in stdout:
@@ -43,14 +44,15 @@ def check_download(
 
 
 @pytest.mark.lg_feature("wan_port")
-def test_wan_wait_for_network(shell_command):
-    for i in range(60):
-        if ubus_call(shell_command, "network.interface.wan", "status").get(
-            "ipv4-address"
-        ):
-            return
+def test_wan_wait_for_network(shell_command, shell_ubus, results_bag):
+    waited = wait_for_interface(shell_command, "wan", timeout=60)
+    assert waited is not None, "WAN interface did not come up within 60 seconds"
 
-    assert False, "WAN interface did not come up within 60 seconds"
+    results_bag["wan_up_wait"] = waited
+
+    status = shell_ubus.call("network.interface.wan", "status")
+    assert status["up"], "WAN interface is not up"
+    results_bag["wan_address"] = status["ipv4-address"][0]["address"]
 
 
 @pytest.mark.lg_feature("online")
@@ -70,59 +72,64 @@ def test_https_download(ssh_command):
     ssh_command.run("rm config.buildinfo")
 
 
-# @pytest.mark.lg_feature("online")
-# def test_http_download(ssh_command):
-#     check_download(
-#         ssh_command,
-#         "http://http.badssl.com",
-#         expect_stderr="Download completed",
-#     )
-
-
-# @pytest.mark.lg_feature("online")
-# def test_https_mozilla(ssh_command):
-#     check_download(
-#         ssh_command,
-#         "https://www.mozilla.org/",
-#         expect_stderr="Download completed",
-#     )
-
-
-# @pytest.mark.lg_feature("online")
-# def test_https_untrusted(ssh_command):
-#     check_download(
-#         ssh_command,
-#         "https://untrusted-root.badssl.com/",
-#         expect_stderr="Connection error: Invalid SSL certificate",
-#         expect_exitcode=5,
-#     )
-
-
-# @pytest.mark.lg_feature("online")
-# def test_https_wrong(ssh_command):
-#     check_download(
-#         ssh_command,
-#         "https://wrong.host.badssl.com/",
-#         expect_stderr="Connection error: Server hostname does not match SSL certificate",
-#         expect_exitcode=5,
-#     )
-
-
-# @pytest.mark.lg_feature("online")
-# def test_https_expired(ssh_command):
-#     check_download(
-#         ssh_command,
-#         "https://expired.badssl.com/",
-#         expect_stderr="Connection error: Invalid SSL certificate",
-#         expect_exitcode=5,
-#     )
-
-
-# @pytest.mark.lg_feature("online")
-# def test_https_rc4(ssh_command):
-#     check_download(
-#         ssh_command,
-#         "https://rc4.badssl.com/",
-#         expect_stderr="Connection error: Connection failed",
-#         4,
-#     )
+# Size of the downloads measuring the throughput of uclient-fetch
+THROUGHPUT_BYTES = 32 * 1024 * 1024
+
+
+@pytest.mark.lg_feature("wan_port")
+def test_http_download(ssh_command, tls_server):
+    check_download(
+        ssh_command,
+        tls_server.url("http"),
+        expect_stderr="Download completed",
+        expect_content="openwrt-tests",
+    )
+
+
+@pytest.mark.lg_feature("wan_port")
+@pytest.mark.parametrize(
+    "scenario, expect_stderr, expect_exitcode",
+    [
+        ("valid", "Download completed", 0),
+        ("untrusted_root", "Connection error: Invalid SSL certificate", 5),
+        (
+            "wrong_host",
+            "Connection error: Server hostname does not match SSL certificate",
+            5,
+        ),
+        ("expired", "Connection error: Invalid SSL certificate", 5),
+        ("weak_cipher", "Connection error: Connection failed", 4),
+    ],
+)
+def test_https_scenario(
+    ssh_command, tls_server, tls_ca, scenario, expect_stderr, expect_exitcode
+):
+    if scenario not in tls_server.servers:
+        pytest.skip(f"The TLS library of this host can not serve {scenario}")
+
+    check_download(
+        ssh_command,
+        tls_server.url(scenario),
+        expect_stderr=expect_stderr,
+        expect_exitcode=expect_exitcode,
+        options=f"--ca-certificate={tls_ca}",
+    )
+
+
+@pytest.mark.lg_feature("wan_port")
+@pytest.mark.parametrize("scenario", ["http", "valid"])
+def test_download_throughput(ssh_command, tls_server, tls_ca, scenario, results_bag):
+    url = tls_server.url(scenario, f"/bytes/{THROUGHPUT_BYTES}")
+    stdout, stderr, exitcode = ssh_command.run(
+        "read start _ < /proc/uptime; "
+        f"wget --ca-certificate={tls_ca} {url} -O /dev/null; ret=$?; "
+        "read end _ < /proc/uptime; echo $start $end; exit $ret",
+        timeout=300,
+    )
+    assert exitcode == 0, f"Download failed: {stderr}"
+
+    start, end = map(float, stdout[-1].split())
+    # /proc/uptime has a resolution of 10ms
+    seconds = max(end - start, 0.01)
+    results_bag["download_seconds"] = round(seconds, 2)
+    results_bag["throughput_mbps"] = round(THROUGHPUT_BYTES * 8 / seconds / 1e6, 1)
@@ -1,28 +1,5 @@
-import time
-
 import pytest
-
-
-def restart_wifi_and_wait(ssh_command, timeout=5):
-    """
-    Helper function to restart wifi via ubus and wait for it to settle.
-
-    Args:
-        ssh_command: SSH command fixture for executing commands
-        timeout: Maximum time to wait for wifi to settle (default: 5 seconds)
-
-    Returns:
-        bool: True if wifi restarted successfully, False if timed out
-    """
-    # Restart wifi
-    ssh_command.run("wifi down")
-    time.sleep(2)
-    ssh_command.run("wifi up")
-    time.sleep(2)
-
-    # Wait till network reload finished
-    result = ssh_command.run(f"ubus -t {timeout} wait_for hostapd.phy0-ap0")[0]
-    return "timed out" not in "\n".join(result)
+from conftest import restart_wifi_and_wait
 
 
 @pytest.mark.lg_feature("wifi")
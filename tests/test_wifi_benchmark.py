@@ -0,0 +1,196 @@
+"""WiFi performance benchmarks between two mac80211_hwsim radios."""
+
+import json
+import statistics
+
+import pytest
+from conftest import restart_wifi_and_wait, run_batch
+
+pytestmark = pytest.mark.lg_feature("hwsim")
+
+REPEAT = 5
+KEY = "testtest"
+STA_ASSOCIATED = (
+    "iwinfo phy1-sta0 assoclist 2>/dev/null | grep -q 'expected throughput'"
+)
+
+
+def distribution(values):
+    """Summarize repeated measurements for the results_bag"""
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "mean": round(statistics.mean(values), 3),
+        "max": max(values),
+        "stdev": round(statistics.stdev(values), 3) if len(values) > 1 else 0.0,
+        "samples": values,
+    }
+
+
+def time_until(ssh_command, action, conditions, timeout=30):
+    """Run action on the DUT, return the seconds until all conditions held in turn
+
+    The conditions are checked on the DUT every 100ms and the time is taken
+    from /proc/uptime, so the round trips to the DUT are not measured.
+    Returns None if a condition did not hold within timeout seconds.
+    """
+    waits = "".join(
+        f"i=0; until {condition}; do i=$((i+1)); "
+        f"[ $i -gt {timeout * 10} ] && exit 1; sleep 0.1; done; "
+        for condition in conditions
+    )
+    stdout, _, exitcode = ssh_command.run(
+        f"read s _ < /proc/uptime; {action}; {waits}read e _ < /proc/uptime; echo $s $e",
+        timeout=timeout * len(conditions) + 30,
+    )
+    if exitcode != 0:
+        return None
+
+    start, end = stdout[-1].split()
+    return round(float(end) - float(start), 2)
+
+
+def run_checked(ssh_command, commands):
+    """Run commands in a single batch, fail with the first one which failed"""
+    for command, result in zip(commands, run_batch(ssh_command, commands)):
+        assert result.exitcode == 0, f"{command} failed: {result.stderr}"
+
+
+@pytest.fixture(autouse=True)
+def restore_wireless(ssh_command):
+    """Restore the wireless configuration changed by configure_hwsim"""
+    ssh_command.run_check("cp /etc/config/wireless /tmp/wireless.hwsim")
+    yield
+    ssh_command.run_check("mv /tmp/wireless.hwsim /etc/config/wireless && wifi")
+
+
+def configure_hwsim(ssh_command, encryption, station=True):
+    """AP on radio0 and, unless disabled, a station on radio1 connecting to it"""
+    commands = [
+        "uci set wireless.radio0.channel=11",
+        "uci set wireless.radio0.band=2g",
+        "uci set wireless.radio0.disabled=0",
+        f"uci set wireless.default_radio0.encryption={encryption}",
+        f"uci set wireless.default_radio0.key={KEY}",
+        # fails if the channel was never set
+        "uci -q delete wireless.radio1.channel || true",
+        "uci set wireless.radio1.band=2g",
+        "uci set wireless.default_radio1.network=wan",
+        "uci set wireless.default_radio1.mode=sta",
+        f"uci set wireless.default_radio1.encryption={encryption}",
+        f"uci set wireless.default_radio1.key={KEY}",
+        "uci set wireless.radio1.disabled=0"
+        if station
+        else "uci set wireless.radio1.disabled=1",
+        "uci commit wireless",
+    ]
+    run_checked(ssh_command, commands)
+
+
+@pytest.mark.parametrize("encryption", ["psk2", "sae", "sae-mixed"])
+def test_hwsim_association_time(ssh_command, encryption, results_bag):
+    configure_hwsim(ssh_command, encryption)
+    assert time_until(ssh_command, "service network reload", [STA_ASSOCIATED]), (
+        "Station did not associate"
+    )
+
+    durations = []
+    for _ in range(REPEAT):
+        down = time_until(ssh_command, "wifi down radio1", [f"! {STA_ASSOCIATED}"])
+        assert down is not None, "Station did not disassociate"
+        duration = time_until(ssh_command, "wifi up radio1", [STA_ASSOCIATED])
+        assert duration is not None, "Station did not associate again"
+        durations.append(duration)
+
+    results_bag["encryption"] = encryption
+    results_bag["association_time"] = distribution(durations)
+
+
+@pytest.mark.parametrize("encryption", ["psk2", "sae", "sae-mixed"])
+def test_hwsim_reconnect_time(ssh_command, encryption, results_bag):
+    configure_hwsim(ssh_command, encryption)
+    assert time_until(ssh_command, "service network reload", [STA_ASSOCIATED]), (
+        "Station did not associate"
+    )
+
+    durations = []
+    for _ in range(REPEAT):
+        # the station is disassociated first, otherwise the old association
+        # would be mistaken for the new one
+        duration = time_until(
+            ssh_command,
+            "service network reload",
+            [f"! {STA_ASSOCIATED}", STA_ASSOCIATED],
+        )
+        assert duration is not None, "Station did not reconnect after reload"
+        durations.append(duration)
+
+    results_bag["encryption"] = encryption
+    results_bag["reconnect_time"] = distribution(durations)
+
+
+@pytest.fixture
+def hwsim_station(ssh_command):
+    """Station on radio1 in its own network namespace, connected to the AP
+
+    With both interfaces in the same namespace traffic between them would
+    be routed locally instead of crossing the hwsim link.
+    """
+    if ssh_command.run("command -v iperf3 iw wpa_supplicant && ip netns list")[2] != 0:
+        pytest.skip("iperf3, iw, wpa_supplicant or ip-full missing on the DUT")
+
+    configure_hwsim(ssh_command, "psk2", station=False)
+    assert restart_wifi_and_wait(ssh_command, 20), "AP did not come up"
+
+    run_checked(
+        ssh_command,
+        [
+            "ip netns add hwsim",
+            "iw phy phy1 set netns name hwsim",
+            "ip netns exec hwsim iw phy phy1 interface add sta0 type managed",
+            (
+                'printf \'network={\\n ssid="OpenWrt"\\n psk="%s"\\n}\\n\' '
+                f"{KEY} > /tmp/hwsim-sta.conf"
+            ),
+            (
+                "ip netns exec hwsim wpa_supplicant -B -i sta0 "
+                "-c /tmp/hwsim-sta.conf -P /tmp/hwsim-sta.pid"
+            ),
+            "ip netns exec hwsim ip addr add 192.168.1.250/24 dev sta0",
+        ],
+    )
+    associated = time_until(
+        ssh_command,
+        "true",
+        ["ip netns exec hwsim iw dev sta0 link | grep -q Connected"],
+    )
+
+    yield associated
+
+    run_batch(
+        ssh_command,
+        [
+            "kill $(cat /tmp/hwsim-sta.pid)",
+            "ip netns exec hwsim iw phy phy1 set netns 1",
+            "ip netns del hwsim",
+            "rm -f /tmp/hwsim-sta.conf /tmp/hwsim-sta.pid",
+        ],
+    )
+
+
+def test_hwsim_throughput(ssh_command, hwsim_station, results_bag):
+    assert hwsim_station is not None, "Station in the namespace did not associate"
+
+    ssh_command.run_check("iperf3 -s -D -B 192.168.1.1 -I /tmp/iperf3.pid")
+    try:
+        rates = []
+        for _ in range(REPEAT):
+            output = ssh_command.run_check(
+                "ip netns exec hwsim iperf3 -c 192.168.1.1 -t 3 -J", timeout=60
+            )
+            end = json.loads("\n".join(output))["end"]
+            rates.append(round(end["sum_received"]["bits_per_second"] / 1e6, 2))
+    finally:
+        ssh_command.run("kill $(cat /tmp/iperf3.pid); rm -f /tmp/iperf3.pid")
+
+    results_bag["throughput_mbps"] = distribution(rates)